@@ -0,0 +1,218 @@
+"""
+Micro-benchmarks of the performance-critical paths, with equivalence checks
+against the implementations they replace
+"""
+import argparse
+import os
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+import torch.nn.functional as F
+import numpy as np
+from model_vc import Generator
+
+
+def timeit(fn, repeat=10):
+    """Average duration of fn() in seconds, after one warm-up call."""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+#======================================== Bottleneck codes ========================================#
+
+def loop_codes(outputs, dim_neck, freq, num_frames):
+    """Former code extraction and upsampling, one code at a time."""
+    out_forward = outputs[:, :, :dim_neck]
+    out_backward = outputs[:, :, dim_neck:]
+    codes = []
+    for i in range(0, outputs.size(1), freq):
+        codes.append(torch.cat((out_forward[:,i+freq-1,:],out_backward[:,i,:]), dim=-1))
+    tmp = []
+    for code in codes:
+        tmp.append(code.unsqueeze(1).expand(-1,int(num_frames/len(codes)),-1))
+    return codes, torch.cat(tmp, dim=1)
+
+
+def tensor_codes(outputs, dim_neck, freq, num_frames):
+    """Strided code extraction and repeat_interleave upsampling of model_vc."""
+    codes = torch.cat((outputs[:, freq-1::freq, :dim_neck],
+                       outputs[:, ::freq, dim_neck:]), dim=-1)
+    return codes, codes.repeat_interleave(num_frames//codes.size(1), dim=1)
+
+
+def loop_forward(G, x, c_org, c_trg):
+    """Generator.forward as it was with the per-code Python loops."""
+    encoder = G.encoder
+    h = x.squeeze(1).transpose(2,1)
+    h = torch.cat((h, c_org.unsqueeze(-1).expand(-1, -1, h.size(-1))), dim=1)
+    for conv in encoder.convolutions:
+        h = F.relu(conv(h))
+    outputs, _ = encoder.lstm(h.transpose(1, 2))
+    codes, code_exp = loop_codes(outputs, encoder.dim_neck, encoder.freq, x.size(1))
+    encoder_outputs = torch.cat((code_exp, c_trg.unsqueeze(1).expand(-1,x.size(1),-1)), dim=-1)
+    mel_outputs = G.decoder(encoder_outputs)
+    mel_outputs_postnet = mel_outputs + G.postnet(mel_outputs.transpose(2,1)).transpose(2,1)
+    return mel_outputs.unsqueeze(1), mel_outputs_postnet.unsqueeze(1), torch.cat(codes, dim=-1)
+
+
+def bench_codes(config):
+    torch.manual_seed(0)
+    G = Generator(config.dim_neck, 256, 512, config.freq).eval()
+    print(f'{"frames":>8} {"codes loop":>12} {"codes tensor":>13} {"speedup":>8} {"G loop":>10} {"G tensor":>10}')
+    with torch.no_grad():
+        for num_frames in config.lengths:
+            x = torch.rand(config.batch_size, num_frames, 80)
+            emb = torch.rand(config.batch_size, 256)
+            # equivalence with the former implementation
+            expected = loop_forward(G, x, emb, emb)
+            for a, b in zip(expected, G(x, emb, emb)):
+                assert torch.equal(a, b), f'Generator output differs for {num_frames} frames'
+
+            outputs = torch.rand(config.batch_size, num_frames, 2*config.dim_neck)
+            t_loop = timeit(lambda: loop_codes(outputs, config.dim_neck, config.freq, num_frames), config.repeat)
+            t_tensor = timeit(lambda: tensor_codes(outputs, config.dim_neck, config.freq, num_frames), config.repeat)
+            t_g_loop = timeit(lambda: loop_forward(G, x, emb, emb), config.repeat)
+            t_g_tensor = timeit(lambda: G(x, emb, emb), config.repeat)
+            print(f'{num_frames:>8} {t_loop*1e3:>10.3f}ms {t_tensor*1e3:>11.3f}ms {t_loop/t_tensor:>7.1f}x '
+                  f'{t_g_loop*1e3:>8.1f}ms {t_g_tensor*1e3:>8.1f}ms')
+
+
+#============================================ Vocoders ============================================#
+
+def bench_vocoder(config):
+    from synthesis import load_vocoder
+    vocoder = load_vocoder(config.vocoder_type, config.checkpoint)
+    if config.mel:
+        c = np.load(config.mel)
+    else:
+        # random spectrogram of the requested duration
+        c = np.random.RandomState(0).rand(int(config.seconds * vocoder.sample_rate / 256), 80).astype(np.float32)
+    duration = c.shape[0] * 256 / vocoder.sample_rate
+    elapsed = timeit(lambda: vocoder(c), config.repeat)
+    print(f'{config.vocoder_type}: {elapsed:.3f}s for {duration:.2f}s of audio, '
+          f'real-time factor {elapsed / duration:.3f}')
+
+
+#==================================== Inference model export ======================================#
+
+def bench_export(config):
+    from export import fold_batchnorm, export_generator
+    torch.manual_seed(0)
+    torch.set_num_threads(config.threads)
+    G = Generator(config.dim_neck, 256, 512, config.freq).eval()
+    folded = fold_batchnorm(G)
+    traced = export_generator(G)
+    models = [('eager', G), ('folded', folded), ('torchscript', traced)]
+    if config.compile:
+        models.append(('compiled', torch.compile(folded)))
+    print(f'{"frames":>8} ' + ' '.join(f'{name:>12}' for name, _ in models) + f' {"speedup":>8} {"max diff":>9}')
+    with torch.inference_mode():
+        for num_frames in config.lengths:
+            x = torch.rand(1, num_frames, 80)
+            emb = torch.rand(1, 256)
+            expected = G(x, emb, emb)[1]
+            times = []
+            diff = 0.
+            for name, model in models:
+                times.append(timeit(lambda: model(x, emb, emb), config.repeat))
+                diff = max(diff, (model(x, emb, emb)[1] - expected).abs().max().item())
+            print(f'{num_frames:>8} ' + ' '.join(f'{t*1e3:>10.1f}ms' for t in times)
+                  + f' {times[0]/min(times[1:]):>7.2f}x {diff:>9.1e}')
+
+
+#===================================== Data-parallel training =====================================#
+
+def ddp_worker(rank, world_size, config, results):
+    """Train the Generator on random batches in one of world_size processes."""
+    torch.set_num_threads(config.threads)
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(config.port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    G = Generator(config.dim_neck, 256, 512, config.freq)
+    model = DistributedDataParallel(G)
+    optimizer = torch.optim.Adam(G.parameters(), 1e-4)
+    x = torch.rand(config.batch_size, config.len_crop, 80)
+    emb = torch.rand(config.batch_size, 256)
+
+    def step():
+        # loss of solver_encoder
+        x_identic, x_identic_psnt, code_real = model(x, emb, emb)
+        code_reconst = model(x_identic_psnt, emb, None)
+        loss = F.mse_loss(x.unsqueeze(1), x_identic) + F.mse_loss(x.unsqueeze(1), x_identic_psnt) \
+            + F.l1_loss(code_real, code_reconst)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(config.steps):
+        step()
+    dist.barrier()
+    if rank == 0:
+        results.put((time.perf_counter() - start) / config.steps)
+    dist.destroy_process_group()
+
+
+def bench_ddp(config):
+    print(f'{"processes":>9} {"step":>9} {"utterances/s":>13} {"speedup":>8} {"efficiency":>11}')
+    results = mp.get_context('spawn').SimpleQueue()
+    base = None
+    for world_size in config.world_sizes:
+        mp.spawn(ddp_worker, args=(world_size, config, results), nprocs=world_size)
+        elapsed = results.get()
+        throughput = world_size * config.batch_size / elapsed
+        base = base or throughput / world_size
+        print(f'{world_size:>9} {elapsed*1e3:>7.0f}ms {throughput:>13.1f} {throughput/base:>7.2f}x '
+              f'{throughput/(world_size*base):>10.0%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    codes = subparsers.add_parser('codes', help='Encoder code extraction and upsampling')
+    codes.add_argument('--lengths', type=int, nargs='+', default=[128, 512, 2048, 8192])
+    codes.add_argument('--batch_size', type=int, default=1)
+    codes.add_argument('--dim_neck', type=int, default=16)
+    codes.add_argument('--freq', type=int, default=16)
+    codes.add_argument('--repeat', type=int, default=10)
+    codes.set_defaults(run=bench_codes)
+
+    vocoder = subparsers.add_parser('vocoder', help='real-time factor of a vocoder')
+    vocoder.add_argument('--vocoder_type', type=str, default='griffinlim', choices=['wavenet', 'griffinlim', 'torchscript'])
+    vocoder.add_argument('--checkpoint', type=str, default=None)
+    vocoder.add_argument('--mel', type=str, default='', help='.npy spectrogram, random if empty')
+    vocoder.add_argument('--seconds', type=float, default=4.)
+    vocoder.add_argument('--repeat', type=int, default=3)
+    vocoder.set_defaults(run=bench_vocoder)
+
+    export = subparsers.add_parser('export', help='eager vs exported Generator inference latency')
+    export.add_argument('--lengths', type=int, nargs='+', default=[128, 256, 512, 1024])
+    export.add_argument('--dim_neck', type=int, default=16)
+    export.add_argument('--freq', type=int, default=16)
+    export.add_argument('--threads', type=int, default=torch.get_num_threads())
+    export.add_argument('--repeat', type=int, default=5)
+    export.add_argument('--compile', action='store_true', help='also time torch.compile')
+    export.set_defaults(run=bench_export)
+
+    ddp = subparsers.add_parser('ddp', help='scaling of data-parallel training with the number of processes')
+    ddp.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4])
+    ddp.add_argument('--threads', type=int, default=1, help='torch threads of each process')
+    ddp.add_argument('--batch_size', type=int, default=2, help='batch size of each process')
+    ddp.add_argument('--len_crop', type=int, default=128)
+    ddp.add_argument('--dim_neck', type=int, default=16)
+    ddp.add_argument('--freq', type=int, default=16)
+    ddp.add_argument('--steps', type=int, default=10)
+    ddp.add_argument('--port', type=int, default=29511)
+    ddp.set_defaults(run=bench_ddp)
+
+    config = parser.parse_args()
+    config.run(config)
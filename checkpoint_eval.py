@@ -1,11 +1,12 @@
-from converter import converter
+from converter import converter, ModelCache
 import argparse
 import os
 import torch
 from torch_utils import device
 
 def checkpoint_eval(dataset,
-    vocoder = 'checkpoint_step001000000_ema.pth', outputFolder ='results', checkpoints_dir='trained_models'):
+    vocoder = 'checkpoint_step001000000_ema.pth', outputFolder ='results', checkpoints_dir='trained_models',
+    vocoder_type='wavenet'):
     spmelFolder = os.path.join(dataset,'spmel')
     wavsFolder = os.path.join(dataset,'wavs')
     print("Doing conversion for each checkpoints...")
@@ -19,16 +20,22 @@ def checkpoint_eval(dataset,
             source = os.path.join(dirName,files[0])
             break
     _, _, files = next(os.walk(checkpoints_dir))
+    # the vocoder, the metadata, the spectrograms and the feature cache are loaded once for all the checkpoints
+    cache = ModelCache(capacity=5)
     for checkpoint in files:
         if not os.path.exists(os.path.join(checkpoints_dir,checkpoint+'_sound')):
             os.makedirs(os.path.join(checkpoints_dir,checkpoint+'_sound'))
         print('Found checkpoint: ',checkpoint)
-        converter(os.path.join(checkpoints_dir,checkpoint), source, target, spmelFolder, wavsFolder, os.path.join(spmelFolder,'train.pkl'), outputFolder=os.path.join(checkpoints_dir,checkpoint+'_sound'))
+        converter(os.path.join(checkpoints_dir,checkpoint), source, target, spmelFolder, wavsFolder, os.path.join(spmelFolder,'train.pkl'),
+                  vocoder=vocoder, outputFolder=os.path.join(checkpoints_dir,checkpoint+'_sound'),
+                  vocoder_type=vocoder_type, cache=cache)
     return
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataset', type=str, default="voxceleb", help='dataset dir')
+    parser.add_argument('--vocoder', type=str, default='checkpoint_step001000000_ema.pth')
+    parser.add_argument('--vocoder_type', type=str, default='wavenet', choices=['wavenet', 'griffinlim', 'torchscript'])
     args = parser.parse_args() 
 
-    checkpoint_eval(args.dataset)
\ No newline at end of file
+    checkpoint_eval(args.dataset, vocoder=args.vocoder, vocoder_type=args.vocoder_type)
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Long-lived voice conversion service
+
+Models, vocoders and speaker metadata stay loaded between requests in an LRU
+cache keyed by checkpoint path and modification time, so that the latency of
+a conversion excludes model loading. Jobs are posted as JSON to /convert,
+with the arguments of converter.converter, and run by a pool of workers:
+
+    curl -X POST localhost:8000/convert -d '{"source": "p225/p225_003.wav", "target": "p228"}'
+
+GET /status lists the cached entries and the number of queued jobs.
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from converter import converter, ModelCache
+
+
+class ConversionServer(ThreadingHTTPServer):
+
+    def __init__(self, address, defaults, num_workers=1, cache_size=6):
+        super().__init__(address, ConversionHandler)
+        self.defaults = defaults
+        self.cache = ModelCache(cache_size)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = 0
+
+    def convert(self, job):
+        """Queue a conversion job and wait for the paths of its wav files."""
+        kwargs = dict(self.defaults, **job)
+        self.pending += 1
+        try:
+            return self.pool.submit(converter, cache=self.cache, **kwargs).result()
+        finally:
+            self.pending -= 1
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.reply(404, {'error': f'Unknown path {self.path}'})
+        self.reply(200, {
+            'cached': [list(key) for key in self.server.cache.keys()],
+            'pending': self.server.pending,
+        })
+
+    def do_POST(self):
+        if self.path != '/convert':
+            return self.reply(404, {'error': f'Unknown path {self.path}'})
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(job, dict):
+                raise ValueError('The job must be a JSON object')
+            unknown = set(job) - set(self.server.defaults)
+            if unknown:
+                raise ValueError(f'Unknown arguments: {", ".join(sorted(unknown))}')
+            if 'source' not in job or 'target' not in job:
+                raise ValueError('source and target are required')
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        start = time.time()
+        try:
+            paths = self.server.convert(job)
+        except Exception as e:
+            return self.reply(500, {'error': str(e)})
+        self.reply(200, {'outputs': paths, 'elapsed': time.time() - start})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--num_workers", type=int, default=1, help='conversion jobs run concurrently')
+    parser.add_argument("--cache_size", type=int, default=6, help='models, metadata files and feature caches kept loaded')
+    # defaults of the jobs, each can be overridden in the request
+    parser.add_argument("--model", default='autovc.ckpt')
+    parser.add_argument("--spmelFolder", default='./training_set/spmel')
+    parser.add_argument("--wavsFolder", default='./training_set/wavs')
+    parser.add_argument("--metadata", default='train.pkl')
+    parser.add_argument("--vocoder", default='checkpoint_step001000000_ema.pth', help='vocoder checkpoint, if any')
+    parser.add_argument("--vocoder_type", default='wavenet', choices=['wavenet', 'griffinlim', 'torchscript'])
+    parser.add_argument("--outputFolder", default='results')
+    parser.add_argument("--encoder", default='3000000-BL.ckpt', help='speaker encoder, for speakers missing from the metadata')
+    parser.add_argument("--cacheFolder", default='conversion_cache', help='spectrograms and embeddings computed from wav files')
+
+    args = parser.parse_args()
+
+    defaults = {
+        'model_ckpt': args.model,
+        'source': None,
+        'target': None,
+        'spmelFolder': args.spmelFolder,
+        'wavsFolder': args.wavsFolder,
+        'metadata_dir': args.metadata,
+        'vocoder': args.vocoder,
+        'vocoder_type': args.vocoder_type,
+        'outputFolder': args.outputFolder,
+        'chunk_len': 0,
+        'overlap': 64,
+        'max_batch_frames': 16384,
+        'vocoder_batch_size': 8,
+        'encoder_ckpt': args.encoder,
+        'cacheFolder': args.cacheFolder,
+    }
+    server = ConversionServer((args.host, args.port), defaults, args.num_workers, args.cache_size)
+    print(f'Serving conversions on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -1,14 +1,25 @@
 import argparse
 import os
 import pickle
+import threading
+import hashlib
+import tempfile
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import Future
 import torch
 import numpy as np
 from math import ceil
 from model_vc import Generator
 from torch_utils import device
 import librosa
-from synthesis import build_model
-from synthesis import wavegen
+from synthesis import load_vocoder
+from embedding_store import EmbeddingStore, store_paths
+from spect_store import SpectStore, INDEX_NAME as SPECT_INDEX_NAME
+from make_spect import SPEC_PARAMS
+from make_metadata import load_speaker_embedding_model
+from melspec import MelSpectrogram
+from export import is_torchscript
 import soundfile as sf
 from torch_utils import device
 
@@ -19,54 +30,330 @@ def pad_seq(x, base=32):
     assert len_pad >= 0
     return np.pad(x, ((0,len_pad),(0,0)), 'constant'), len_pad
 
-def get_embedding(metadata, speaker):
-    for sbmt_i in metadata:
-        if sbmt_i[0] == speaker:
-            return torch.from_numpy(sbmt_i[1][np.newaxis, :]).to(device)
-    raise Exception(f'Embedding was not found for speaker {speaker}.')
-    #TODO : generate embedding from David's functions
+def load_embeddings(metadata_dir, cache):
+    """Speaker embeddings from the store of metadata_dir, written by
+    make_metadata, or from metadata_dir itself when it has no up-to-date store."""
+    if EmbeddingStore.exists(metadata_dir):
+        return cache.get('embeddings', store_paths(metadata_dir)[0], lambda: EmbeddingStore.load(metadata_dir))
+    return cache.get('metadata', metadata_dir,
+                     lambda: EmbeddingStore.from_metadata(pickle.load(open(metadata_dir, "rb"))))
 
-def get_uttr_melspect(uttr_wav_path, spmelFolder):
+def get_embedding(embeddings, speaker):
+    if speaker not in embeddings:
+        raise Exception(f'Embedding was not found for speaker {speaker}.')
+    return torch.from_numpy(np.array(embeddings[speaker], dtype=np.float32)[np.newaxis, :]).to(device)
+
+class FeatureCache(object):
+    """Mel-spectrograms and speaker embeddings computed from wav files at
+    conversion time, cached on disk under a hash of the file contents.
+
+    Spectrograms are extracted as in make_spect and embeddings are averaged
+    over crops of a few reference utterances as in make_metadata, so that
+    speakers and utterances missing from the preprocessed dataset can still
+    be converted.
+    """
+
+    def __init__(self, cache_dir='conversion_cache', num_uttrs=10, len_crop=128):
+        self.cache_dir = cache_dir
+        self.num_uttrs = num_uttrs
+        self.len_crop = len_crop
+        self.extractor = MelSpectrogram(**SPEC_PARAMS)
+        # file path -> (mtime, content hash)
+        self.hashes = {}
+
+    def content_hash(self, path):
+        mtime = os.path.getmtime(path)
+        if self.hashes.get(path, (None,))[0] != mtime:
+            digest = hashlib.sha1(repr(sorted(SPEC_PARAMS.items())).encode())
+            with open(path, 'rb') as handle:
+                for block in iter(lambda: handle.read(1 << 20), b''):
+                    digest.update(block)
+            self.hashes[path] = (mtime, digest.hexdigest())
+        return self.hashes[path][1]
+
+    def _cached(self, name, compute):
+        path = os.path.join(self.cache_dir, name + '.npy')
+        if os.path.isfile(path):
+            return np.load(path)
+        value = compute()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # unique temporary name, the cache may be shared by concurrent conversions
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False) as handle:
+            np.save(handle, value, allow_pickle=False)
+        os.replace(handle.name, path)
+        return value
+
+    def mel(self, wav_path):
+        """(num_frames, 80) spectrogram of a wav file."""
+        return self._cached('mel_' + self.content_hash(wav_path),
+                            lambda: self.extractor.from_files([wav_path])[0])
+
+    def embedding(self, wav_paths, C, C_ckpt):
+        """(dim_emb,) speaker embedding of reference utterances, by the
+        D_VECTOR C loaded from C_ckpt."""
+        wav_paths = sorted(wav_paths)[:self.num_uttrs]
+        if not wav_paths:
+            raise Exception('No reference utterance to compute the speaker embedding from.')
+        key = hashlib.sha1(repr((os.path.abspath(C_ckpt), os.path.getmtime(C_ckpt), self.len_crop,
+                                 [self.content_hash(path) for path in wav_paths])).encode()).hexdigest()
+
+        def compute():
+            embs = []
+            for wav_path in wav_paths:
+                tmp = self.mel(wav_path)
+                # central crop, or the whole utterance when it is shorter
+                left = max(0, (tmp.shape[0] - self.len_crop) // 2)
+                melsp = torch.from_numpy(tmp[np.newaxis, left:left+self.len_crop, :]).to(device)
+                with torch.no_grad():
+                    embs.append(C(melsp).squeeze(0).cpu().numpy())
+            return np.mean(embs, axis=0).astype(np.float32)
+
+        return self._cached('emb_' + key, compute)
+
+def speaker_embedding(embeddings, speaker, wavsFolder, features, cache, encoder_ckpt):
+    """Embedding of a speaker of the metadata, or computed from the wav files
+    of wavsFolder/speaker when the speaker is unseen."""
+    if speaker in embeddings:
+        return get_embedding(embeddings, speaker)
+    speaker_dir = os.path.join(wavsFolder, speaker)
+    if features is None or not os.path.isdir(speaker_dir):
+        raise Exception(f'Embedding was not found for speaker {speaker}.')
+    print(f'Computing the embedding of unseen speaker {speaker}')
+    wav_paths = [os.path.join(root, file) for root, _, files in os.walk(speaker_dir)
+                 for file in files if file.lower().endswith('.wav')]
+    C = cache.get('speaker_encoder', encoder_ckpt, lambda: load_speaker_embedding_model(encoder_ckpt).eval())
+    return torch.from_numpy(features.embedding(wav_paths, C, encoder_ckpt)[np.newaxis, :]).to(device)
+
+def get_uttr_melspect(uttr_wav_path, spmelFolder, wavsFolder=None, features=None, mmap_mode=None, store=None):
+    """Spectrogram of a wav file of the dataset, read from the packed store
+    when spmelFolder has one, from its .npy file otherwise, or extracted
+    from the wav file by features. With mmap_mode, the spectrogram is
+    returned without being read into memory, possibly as float16."""
+    if store is not None:
+        speaker, *parts = uttr_wav_path.split('/')
+        # make_spect names the spectrograms of speaker/sub/file.wav speaker/subfile.npy
+        for key in (uttr_wav_path[:-4] + '.npy', speaker + '/' + ''.join(parts)[:-4] + '.npy'):
+            if key in store:
+                return store[key] if mmap_mode else np.array(store[key], dtype=np.float32)
     uttr_spmel_path = os.path.join(spmelFolder,uttr_wav_path[:-4]+'.npy')
     mel_spect_exists = os.path.isfile(uttr_spmel_path)
     if mel_spect_exists:
-        mlspect = np.load(uttr_spmel_path)
+        mlspect = np.load(uttr_spmel_path, mmap_mode=mmap_mode)
     else:
         alter_suffix = os.path.join(uttr_spmel_path.split('/')[-3], ''.join(uttr_spmel_path.split('/')[-2:]))
-        alter_uttr_spmel_path = os.path.join(args.spmelFolder,alter_suffix)
+        alter_uttr_spmel_path = os.path.join(spmelFolder,alter_suffix)
         if os.path.isfile(alter_uttr_spmel_path):
-            return get_uttr_melspect(alter_suffix)
+            return np.load(alter_uttr_spmel_path, mmap_mode=mmap_mode)
+        elif features is not None and os.path.isfile(os.path.join(wavsFolder, uttr_wav_path)):
+            return features.mel(os.path.join(wavsFolder, uttr_wav_path))
         else:
-            #TODO : implement auto-convert
-            raise Exception(f'The spectogram for {uttr_wav_path} does not exist, auto-convert is not supported yet.')
+            raise Exception(f'The spectogram for {uttr_wav_path} does not exist.')
     return mlspect
 
+def load_generator(model_ckpt):
+    if is_torchscript(model_ckpt):
+        # standalone inference model, made by export.py
+        return torch.jit.load(model_ckpt, map_location=device).eval()
+    g_checkpoint = torch.load(model_ckpt, map_location=device)
+    default_hparams = {
+        'dim_neck': 32,
+        'dim_emb': 256,
+        'dim_pre': 512,
+        'freq': 32
+    }
+    hparams = g_checkpoint.get('hyperparams', default_hparams)
+    G = Generator(hparams['dim_neck'],hparams['dim_emb'],hparams['dim_pre'],hparams['freq']).eval().to(device)
+
+    G.load_state_dict(g_checkpoint.get('G_state_dict', g_checkpoint.get('model')))
+    return G
+
+class ModelCache(object):
+    """Least-recently-used cache of loaded models and metadata.
+
+    Entries are keyed by kind, file path and modification time, so that a
+    retrained checkpoint is reloaded while an unchanged one is loaded once.
+    """
+
+    def __init__(self, capacity=6):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        # key -> Future of the entries being loaded
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, path, load):
+        """Return the cached load() result for path, loading it on a miss.
+
+        The lock only guards the table: load() runs outside of it, so that a
+        slow load does not block the other entries, and concurrent misses of
+        the same key wait for a single load.
+        """
+        mtime = os.path.getmtime(path) if path and os.path.isfile(path) else None
+        key = (kind, path, mtime)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            future = self.loading.get(key)
+            loader = future is None
+            if loader:
+                future = self.loading[key] = Future()
+        if not loader:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            # drop stale versions of the same file
+            for other in [other for other in self.entries if other[:2] == key[:2]]:
+                del self.entries[other]
+            self.entries[key] = value
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+# shared by every converter call of the process
+model_cache = ModelCache()
+
+def convert(G, x_org, emb_org, emb_trg):
+    """Convert a whole (num_frames, 80) mel-spectrogram at once."""
+    x_org, len_pad = pad_seq(x_org)
+    uttr_org = torch.from_numpy(x_org[np.newaxis, :, :]).to(device)
+
+    _, x_identic_psnt, _ = G(uttr_org, emb_org, emb_trg)
+    if len_pad == 0:
+        return x_identic_psnt[0, 0, :, :].cpu().numpy()
+    return x_identic_psnt[0, 0, :-len_pad, :].cpu().numpy()
+
+def convert_batch(G, x_orgs, emb_org, emb_trg, max_batch_frames=16384):
+    """Convert many mel-spectrograms, running those of the same padded length
+    through the Generator together.
+
+    emb_org and emb_trg are (1, dim_emb) embeddings shared by every utterance
+    or (len(x_orgs), dim_emb) ones for many-to-many conversions. A batch holds
+    at most max_batch_frames padded frames (but at least one utterance).
+    Outputs match converting the utterances one by one up to float rounding.
+    """
+    padded = [pad_seq(x_org) for x_org in x_orgs]
+    groups = {}
+    for k, (x_org, _) in enumerate(padded):
+        groups.setdefault(x_org.shape[0], []).append(k)
+
+    uttr_trgs = len(x_orgs) * [None]
+    for len_out, indices in groups.items():
+        batch_size = max(1, max_batch_frames // len_out)
+        for i in range(0, len(indices), batch_size):
+            batch = indices[i:i+batch_size]
+            uttr_org = torch.from_numpy(np.stack([padded[k][0] for k in batch])).to(device)
+            select = torch.tensor(batch, device=device)
+            c_org = emb_org.expand(len(batch), -1) if emb_org.size(0) == 1 else emb_org[select]
+            c_trg = emb_trg.expand(len(batch), -1) if emb_trg.size(0) == 1 else emb_trg[select]
+            _, x_identic_psnt, _ = G(uttr_org, c_org, c_trg)
+            x_identic_psnt = x_identic_psnt[:, 0].cpu().numpy()
+            for j, k in enumerate(batch):
+                uttr_trgs[k] = x_identic_psnt[j, :len_out-padded[k][1]]
+    return uttr_trgs
+
+def convert_stream(G, x_org, emb_org, emb_trg, chunk_len=512, overlap=64, base=32):
+    """Convert a mel-spectrogram chunk by chunk, yielding the converted frames
+    as soon as they are final.
+
+    x_org is a (num_frames, 80) array, possibly memory-mapped, or an iterable
+    of such blocks of frames. Chunks of chunk_len frames start every
+    chunk_len - overlap frames, so that they stay aligned on the code grid
+    (multiples of base, itself a multiple of the model freq), and the outputs
+    of consecutive chunks are linearly cross-faded over their overlap. Memory
+    is bounded by the chunk size whatever the length of the input.
+    """
+    if chunk_len % base or overlap % base or not 0 <= overlap < chunk_len:
+        raise ValueError(f'chunk_len and overlap must be multiples of {base}, with overlap < chunk_len')
+    hop = chunk_len - overlap
+    if isinstance(x_org, np.ndarray):
+        frames = x_org
+        x_org = (frames[i:i+chunk_len] for i in range(0, frames.shape[0], chunk_len))
+    fade_in = ((np.arange(overlap) + 0.5) / overlap).astype(np.float32)[:, np.newaxis]
+
+    def crossfade(tail, out):
+        if tail is not None:
+            n = tail.shape[0]
+            out[:n] = tail * (1 - fade_in[:n]) + out[:n] * fade_in[:n]
+        return out
+
+    pending = None  # input frames not converted yet, starting with the overlap
+    tail = None  # converted frames of the previous chunk over the overlap
+    for block in x_org:
+        block = np.asarray(block, dtype=np.float32)
+        pending = block if pending is None else np.concatenate((pending, block))
+        while pending.shape[0] >= chunk_len:
+            out = crossfade(tail, convert(G, pending[:chunk_len], emb_org, emb_trg))
+            pending = pending[hop:]
+            tail = out[hop:]
+            yield out[:hop]
+    if pending is None:
+        return
+    if tail is not None and pending.shape[0] == tail.shape[0]:
+        yield tail
+    elif pending.shape[0] > 0:
+        yield crossfade(tail, convert(G, pending, emb_org, emb_trg))
+
+def convert_to_file(G, x_org, emb_org, emb_trg, path, chunk_len=512, overlap=64):
+    """Convert a mel-spectrogram with convert_stream, writing the converted
+    frames to a memory-mapped .npy file at path as they come. Returns the
+    memory map, so that the converted utterance is never held in memory."""
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(x_org.shape[0], x_org.shape[1]))
+    i = 0
+    for frames in convert_stream(G, x_org, emb_org, emb_trg, chunk_len, overlap):
+        out[i:i+frames.shape[0]] = frames
+        i += frames.shape[0]
+    out.flush()
+    return out
+
 def converter(model_ckpt, source, target, spmelFolder, wavsFolder, metadata_dir,
- vocoder = 'checkpoint_step001000000_ema.pth', outputFolder ='results'):
-    if not os.path.isdir(outputFolder):
-        os.mkdir(outputFolder)
+ vocoder = 'checkpoint_step001000000_ema.pth', outputFolder ='results', chunk_len=0, overlap=64,
+ max_batch_frames=16384, vocoder_type='wavenet', vocoder_batch_size=8, cache=model_cache,
+ encoder_ckpt='3000000-BL.ckpt', cacheFolder='conversion_cache'):
+    """Convert source (a wav file or a speaker directory under wavsFolder) to
+    the voice of the target speaker and return the paths of the written wav
+    files. Models and metadata are loaded through cache.
+
+    Spectrograms missing from spmelFolder and embeddings of speakers missing
+    from the metadata are computed from wavsFolder with the speaker encoder
+    encoder_ckpt, and kept in cacheFolder (disabled if cacheFolder is None).
+
+    With chunk_len, the source spectrograms are memory-mapped and converted
+    chunk by chunk into memory-mapped files of outputFolder, so the
+    Generator stage uses bounded memory. The vocoder still synthesizes each
+    utterance in one piece, and holds its whole waveform in memory.
+    """
+    os.makedirs(outputFolder, exist_ok=True)
     source = source.replace('\\', '/')
     target = target.replace('\\', '/')
     source_person = source.split('/')[0]
     source_spmel_path =  os.path.join(source_person,''.join(source.split('/')[1:]))
     target_person = target.split('/')[0]
     with torch.no_grad():
-        g_checkpoint = torch.load(args.model, map_location=device)
-        default_hparams = {
-            'dim_neck': 32,
-            'dim_emb': 256,
-            'dim_pre': 512,
-            'freq': 32
-        }
-        hparams = g_checkpoint.get('hyperparams', default_hparams)
-        G = Generator(hparams['dim_neck'],hparams['dim_emb'],hparams['dim_pre'],hparams['freq']).eval().to(device)
-
-        G.load_state_dict(g_checkpoint.get('G_state_dict', g_checkpoint.get('model')))
-        metadata = pickle.load(open(os.path.join(args.spmelFolder, args.metadata), "rb"))
-        spect_vc = []
-
-        emb_org = get_embedding(metadata, source_person)
-        emb_trg = get_embedding(metadata, target_person)
+        G = cache.get('generator', model_ckpt, lambda: load_generator(model_ckpt))
+        # metadata_dir is either a path or a file name in spmelFolder
+        if not os.path.isfile(metadata_dir):
+            metadata_dir = os.path.join(spmelFolder, metadata_dir)
+        embeddings = load_embeddings(metadata_dir, cache)
+        store = cache.get('spect_store', os.path.join(spmelFolder, SPECT_INDEX_NAME),
+                          lambda: SpectStore(spmelFolder)) if SpectStore.exists(spmelFolder) else None
+        # kept between calls with its table of file hashes
+        features = cache.get('features', cacheFolder, lambda: FeatureCache(cacheFolder)) if cacheFolder else None
+
+        emb_org = speaker_embedding(embeddings, source_person, wavsFolder, features, cache, encoder_ckpt)
+        emb_trg = speaker_embedding(embeddings, target_person, wavsFolder, features, cache, encoder_ckpt)
 
         source_path = os.path.join(wavsFolder,source)
         if os.path.isfile(source_path):
@@ -76,32 +363,34 @@ def converter(model_ckpt, source, target, spmelFolder, wavsFolder, metadata_dir,
         else:
             raise Exception(f'Wrong path: {source_path}')
 
+        names = []
+        x_orgs = []
         for x_org_source in X_orgs:
             x_org_source = x_org_source.replace('\\', '/')
             source_file = '__'.join(x_org_source.split('/')[1:])
-            x_org = get_uttr_melspect(x_org_source, spmelFolder=spmelFolder)
-            x_org, len_pad = pad_seq(x_org)
-            uttr_org = torch.from_numpy(x_org[np.newaxis, :, :]).to(device)
-
-            _, x_identic_psnt, _ = G(uttr_org, emb_org, emb_trg)
-            if len_pad == 0:
-                uttr_trg = x_identic_psnt[0, 0, :, :].cpu().numpy()
+            names.append('{}_{}_by_{}'.format(source_person,source_file[:-4], target_person))
+            x_orgs.append(get_uttr_melspect(x_org_source, spmelFolder=spmelFolder, wavsFolder=wavsFolder,
+                                            features=features, mmap_mode='r' if chunk_len else None,
+                                            store=store))
+        with tempfile.TemporaryDirectory(dir=outputFolder) if chunk_len else nullcontext() as spect_dir:
+            if chunk_len:
+                uttr_trgs = [convert_to_file(G, x_org, emb_org, emb_trg, os.path.join(spect_dir, f'{k}.npy'),
+                                             chunk_len, overlap)
+                             for k, x_org in enumerate(x_orgs)]
             else:
-                uttr_trg = x_identic_psnt[0, 0, :-len_pad, :].cpu().numpy()
-            spect_vc.append( ('{}_{}_by_{}'.format(source_person,source_file[:-4], target_person), uttr_trg) )
-
-        del G
-        del g_checkpoint
+                uttr_trgs = convert_batch(G, x_orgs, emb_org, emb_trg, max_batch_frames)
+            del x_orgs
 
-        model = build_model().to(device)
-        checkpoint = torch.load(vocoder, map_location=torch.device(device))
-        model.load_state_dict(checkpoint["state_dict"])
+            model = cache.get('vocoder_' + vocoder_type, vocoder, lambda: load_vocoder(vocoder_type, vocoder))
 
-        for spect in spect_vc:
-            name = spect[0]
-            c = spect[1]
-            waveform = wavegen(model, c=c)
-            sf.write(f'{outputFolder}/{name}.wav', waveform, samplerate=16000)
+            waveforms = model.batch(uttr_trgs, vocoder_batch_size)
+            paths = []
+            for name, waveform in zip(names, waveforms):
+                paths.append(f'{outputFolder}/{name}.wav')
+                sf.write(paths[-1], waveform, samplerate=16000)
+            # release the memory maps before their files are removed
+            del uttr_trgs, waveforms
+    return paths
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -111,11 +400,21 @@ if __name__ == '__main__':
     parser.add_argument("--spmelFolder", default='./training_set/spmel')
     parser.add_argument("--wavsFolder", default='./training_set/wavs')
     parser.add_argument("--metadata", default='train.pkl')
-    parser.add_argument("--vocoder", default='checkpoint_step001000000_ema.pth')
+    parser.add_argument("--vocoder", default='checkpoint_step001000000_ema.pth', help='vocoder checkpoint, if any')
+    parser.add_argument("--vocoder_type", default='wavenet', choices=['wavenet', 'griffinlim', 'torchscript'])
+    parser.add_argument("--vocoder_batch_size", type=int, default=8, help='utterances synthesized together by WaveNet')
     parser.add_argument("--outputFolder", default='results')
+    parser.add_argument("--encoder", default='3000000-BL.ckpt', help='speaker encoder, for speakers missing from the metadata')
+    parser.add_argument("--cacheFolder", default='conversion_cache', help='spectrograms and embeddings computed from wav files')
+    parser.add_argument("--chunk_len", type=int, default=0, help='convert by overlapping chunks of this many frames (0: whole utterance)')
+    parser.add_argument("--overlap", type=int, default=64, help='overlap of consecutive chunks, in frames')
+    parser.add_argument("--max_batch_frames", type=int, default=16384, help='maximum number of padded frames converted at once')
 
     args = parser.parse_args()
 
     converter(model_ckpt= args.model, source=args.source, target=args.target,
      spmelFolder=args.spmelFolder, wavsFolder= args.wavsFolder,
-      metadata_dir= args.metadata, vocoder=args.vocoder, outputFolder=args.outputFolder)
+      metadata_dir= args.metadata, vocoder=args.vocoder, outputFolder=args.outputFolder,
+      chunk_len=args.chunk_len, overlap=args.overlap, max_batch_frames=args.max_batch_frames,
+      vocoder_type=args.vocoder_type, vocoder_batch_size=args.vocoder_batch_size,
+      encoder_ckpt=args.encoder, cacheFolder=args.cacheFolder)
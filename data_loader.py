@@ -5,62 +5,217 @@ import numpy as np
 import pickle
 import os
 
-from multiprocessing import Process, Manager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from spect_store import SpectStore
+from torch_utils import is_distributed, get_rank, get_world_size, shared_seed
 
 
 class Utterances(data.Dataset):
     """Dataset class for the Utterances dataset."""
 
-    def __init__(self, root_dir, len_crop):
+    # number of leading fields (speaker id, embedding, ...) in each entry of train.pkl
+    meta_fields = 2
+
+    def __init__(self, root_dir, len_crop, load_mode='eager'):
         """Initialize and preprocess the Utterances dataset."""
         self.root_dir = root_dir
         print(root_dir)
         self.len_crop = len_crop
-        self.step = 10
+        self.load_mode = load_mode
+        self._store = None
+        self._batch_index = None
+        # set by get_loader: batches allocated in page-locked memory
+        self.pin_memory = False
+        # set by get_loader for length-bucketed batches of whole utterances
+        self.bucketed = False
+        self.freq = None
+        self.max_len_crop = None
 
         metaname = os.path.join(self.root_dir, "train.pkl")
         meta = pickle.load(open(metaname, "rb"))
 
-        """Load data using multiprocessing"""
-        manager = Manager()
-        meta = manager.list(meta)
-        dataset = manager.list(len(meta)*[None])
-        processes = []
-        print('Loading data by batches...')
-        for i in range(0, len(meta), self.step):
-            p = Process(target=self.load_data,
-                        args=(meta[i:i+self.step],dataset,i))
-            p.start()
-            processes.append(p)
-        for p in tqdm.tqdm(processes):
-            p.join()
-
-        self.train_dataset = list(dataset)
+        if load_mode == 'lazy':
+            # keep the utterance paths only, spectrograms are read on access
+            self.train_dataset = meta
+            self.num_tokens = len(self.train_dataset)
+            return
+        elif load_mode != 'eager':
+            raise ValueError(f'Unknown load mode: {load_mode}')
+
+        self.load_shared(meta)
         self.num_tokens = len(self.train_dataset)
 
         print('Finished loading the dataset...')
 
 
-    def load_data(self, submeta, dataset, idx_offset):
-        for k, sbmt in enumerate(submeta):
-            uttrs = len(sbmt)*[None]
-            for j, tmp in enumerate(sbmt):
-                if j < 2:  # fill in speaker id and embedding
-                    uttrs[j] = tmp
-                else: # load the mel-spectrograms
-                    uttrs[j] = np.load(os.path.join(self.root_dir, tmp))
-            dataset[idx_offset+k] = uttrs
+    def load_shared(self, meta):
+        """Read every spectrogram into a single shared-memory block.
 
+        Utterances are replaced in train_dataset by their (offset, length) in
+        the block, which DataLoader workers share without copying it.
+        """
+        # read from the packed store when make_spect wrote one
+        store = SpectStore(self.root_dir) if SpectStore.exists(self.root_dir) else None
+        keys = [uttr for sbmt in meta for uttr in sbmt[self.meta_fields:]]
 
-    def __getitem__(self, index):
-        # pick a random speaker
-        dataset = self.train_dataset
-        list_uttrs = dataset[index]
-        emb_org = list_uttrs[1]
+        def read(key, mmap_mode=None):
+            if store is not None:
+                return store[key]
+            return np.load(os.path.join(self.root_dir, key), mmap_mode=mmap_mode)
 
-        # pick random uttr with random crop
-        a = np.random.randint(2, len(list_uttrs))
-        tmp = list_uttrs[a]
+        print('Loading data...')
+        with ThreadPool(cpu_count()) as pool:
+            shapes = pool.map(lambda key: read(key, 'r').shape, keys)
+            lengths = [shape[0] for shape in shapes]
+            offsets = np.cumsum([0] + lengths[:-1]).tolist()
+            n_mels = shapes[0][1] if shapes else 80
+            self.frames_t = torch.empty((sum(lengths), n_mels)).share_memory_()
+            self.frames = self.frames_t.numpy()
+
+            def load(k):
+                self.frames[offsets[k]:offsets[k]+lengths[k]] = read(keys[k])
+            for _ in tqdm.tqdm(pool.imap_unordered(load, range(len(keys)), chunksize=16), total=len(keys)):
+                pass
+
+        positions = iter(zip(offsets, lengths))
+        self.train_dataset = [list(sbmt[:self.meta_fields]) + [next(positions) for _ in sbmt[self.meta_fields:]]
+                              for sbmt in meta]
+
+
+    def __getstate__(self):
+        # memory maps are reopened by each DataLoader worker
+        state = self.__dict__.copy()
+        state['_store'] = None
+        state.pop('frames', None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'frames_t' in state:
+            self.frames = self.frames_t.numpy()
+
+
+    def get_mel(self, uttr):
+        """Return a spectrogram, memory-mapping it in lazy mode."""
+        if self.load_mode == 'eager':
+            offset, length = uttr
+            return self.frames[offset:offset+length]
+        if self.store:
+            return self.store[uttr]
+        return np.load(os.path.join(self.root_dir, uttr), mmap_mode='r')
+
+
+    @property
+    def store(self):
+        """Packed store of the lazy mode, False if there is none."""
+        if self._store is None:
+            self._store = SpectStore(self.root_dir) if SpectStore.exists(self.root_dir) else False
+        return self._store
+
+
+    def get_frames(self):
+        """Contiguous frame array holding every utterance, or None."""
+        if self.load_mode == 'eager':
+            return self.frames
+        return self.store.frames if self.store else None
+
+
+    def batch_index(self):
+        """Flat offsets/lengths of the utterances, grouped by speaker, and
+        the speaker embeddings, used to crop whole batches at once."""
+        if self._batch_index is None:
+            self._batch_index = {
+                'embs': np.stack([uttrs[1] for uttrs in self.train_dataset]).astype(np.float32),
+            }
+            if self.load_mode == 'eager':
+                positions = [uttrs[self.meta_fields:] for uttrs in self.train_dataset]
+            elif self.store:
+                positions = [[self.store.utterances[uttr] for uttr in uttrs[self.meta_fields:]]
+                             for uttrs in self.train_dataset]
+            else:
+                positions = None
+            if positions is not None:
+                counts = np.array([len(pos) for pos in positions])
+                flat = np.array([p for pos in positions for p in pos], dtype=np.int64).reshape(-1, 2)
+                self._batch_index.update({
+                    'offsets': flat[:, 0],
+                    'lengths': flat[:, 1],
+                    'first': np.cumsum(counts) - counts,
+                    'counts': counts,
+                })
+        return self._batch_index
+
+
+    def crop_batch(self, speakers):
+        """Random crops of one random utterance of each speaker, drawn and
+        gathered for the whole batch at once."""
+        frames = self.get_frames()
+        if frames is None:
+            # separate .npy files, crop them one by one
+            crops = [self.crop(self.get_mel(self.train_dataset[spk][
+                np.random.randint(self.meta_fields, len(self.train_dataset[spk]))])) for spk in speakers]
+            return torch.from_numpy(np.stack(crops))
+        index = self.batch_index()
+        uttrs = index['first'][speakers] + (np.random.random(len(speakers)) * index['counts'][speakers]).astype(np.int64)
+        return self.crop_utterances(uttrs, self.len_crop)
+
+
+    def crop_utterances(self, uttrs, len_crop):
+        """Random crops of len_crop frames of the given flat utterance indices."""
+        frames = self.get_frames()
+        index = self.batch_index()
+        batch_size = len(uttrs)
+        lengths = index['lengths'][uttrs]
+        left = (np.random.random(batch_size) * np.maximum(lengths - len_crop, 0)).astype(np.int64)
+        steps = np.arange(len_crop)
+        valid = steps < lengths[:, np.newaxis]
+        rows = (index['offsets'][uttrs] + left)[:, np.newaxis] + np.minimum(steps, lengths[:, np.newaxis] - 1)
+
+        # allocate the batch pinned in the main process, workers' batches are pinned by the DataLoader
+        pin = self.pin_memory and torch.cuda.is_available() and data.get_worker_info() is None
+        batch = torch.empty((batch_size, len_crop, frames.shape[1]), pin_memory=pin)
+        out = batch.numpy().reshape(-1, frames.shape[1])
+        if frames.dtype == np.float32:
+            np.take(frames, rows.reshape(-1), axis=0, out=out)
+        else:
+            out[:] = frames[rows.reshape(-1)]
+        # zero-pad the utterances shorter than len_crop
+        out[~valid.reshape(-1)] = 0
+        return batch
+
+
+    def bucket_lengths(self, freq, max_len_crop):
+        """Training length of every utterance in bucketed mode: its length
+        rounded down to a multiple of freq, capped to max_len_crop."""
+        if self.get_frames() is None:
+            raise ValueError('Bucketed mode needs eager loading or a packed store.')
+        lengths = np.minimum(self.batch_index()['lengths'], max_len_crop)
+        return np.maximum(lengths // freq, 1) * freq
+
+
+    def get_uttr_batch(self, uttrs):
+        """Batch of whole utterances of similar length, cropped to the
+        shortest one of them."""
+        uttrs = np.asarray(uttrs)
+        index = self.batch_index()
+        speakers = np.repeat(np.arange(len(index['counts'])), index['counts'])[uttrs]
+        len_crop = self.bucket_lengths(self.freq, self.max_len_crop)[uttrs].min()
+        return self.crop_utterances(uttrs, len_crop), speakers
+
+
+    def get_batch(self, indices):
+        if self.bucketed:
+            batch, speakers = self.get_uttr_batch(indices)
+        else:
+            speakers = np.asarray(indices)
+            batch = self.crop_batch(speakers)
+        return batch, torch.from_numpy(self.batch_index()['embs'][speakers])
+
+
+    def crop(self, tmp):
+        """Random crop of len_crop frames, zero-padded if the utterance is shorter."""
         if tmp.shape[0] < self.len_crop:
             len_pad = self.len_crop - tmp.shape[0]
             uttr = np.pad(tmp, ((0,len_pad),(0,0)), 'constant')
@@ -69,6 +224,24 @@ class Utterances(data.Dataset):
             uttr = tmp[left:left+self.len_crop, :]
         else:
             uttr = tmp
+        if isinstance(uttr, np.memmap) or uttr.dtype != np.float32:
+            # copy the crop out of the read-only memory map
+            uttr = np.array(uttr, dtype=np.float32)
+        return uttr
+
+
+    def __getitem__(self, index):
+        if isinstance(index, list):
+            # whole batch drawn by a BatchSampler
+            return self.get_batch(index)
+        # pick a random speaker
+        dataset = self.train_dataset
+        list_uttrs = dataset[index]
+        emb_org = list_uttrs[1]
+
+        # pick random uttr with random crop
+        a = np.random.randint(self.meta_fields, len(list_uttrs))
+        uttr = self.crop(self.get_mel(list_uttrs[a]))
 
         return uttr, emb_org
 
@@ -80,16 +253,161 @@ class Utterances(data.Dataset):
 
 
 
-def get_loader(root_dir, batch_size=16, len_crop=128, num_workers=0):
+def worker_init_fn(worker_id):
+    # torch seeds every worker differently at each epoch, derive numpy's seed
+    # from it so that the random crops differ between workers
+    np.random.seed(torch.initial_seed() % (2**32))
+
+
+def loader_kwargs(num_workers=0, pin_memory=False, persistent_workers=False, prefetch_factor=2):
+    """DataLoader options shared by the plain and circular loaders."""
+    kwargs = {'num_workers': num_workers,
+              'pin_memory': pin_memory,
+              'worker_init_fn': worker_init_fn}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+    return kwargs
+
+
+def speaker_sampler(dataset):
+    """Random order of the speakers, split between the processes in
+    data-parallel training."""
+    if is_distributed():
+        return data.distributed.DistributedSampler(dataset, seed=shared_seed(), drop_last=True)
+    return data.RandomSampler(dataset)
+
+
+def batch_loader(dataset, batch_size, sampler=None, **kwargs):
+    """DataLoader handing whole lists of indices to the dataset, which crops
+    and collates the batch itself."""
+    if sampler is None:
+        sampler = speaker_sampler(dataset)
+    sampler = data.BatchSampler(sampler, batch_size, drop_last=True)
+    return data.DataLoader(dataset=dataset,
+                           sampler=sampler,
+                           batch_size=None,
+                           **kwargs)
+
+
+class BucketBatchSampler(data.Sampler):
+    """Batches of utterances that share the same bucket length.
+
+    In data-parallel training every process draws the same batches, from
+    (seed, epoch), and keeps every num_replicas-th one.
+    """
+
+    def __init__(self, lengths, batch_size, drop_last=True, num_replicas=1, rank=0, seed=None):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.buckets = {}
+        for uttr, length in enumerate(lengths):
+            self.buckets.setdefault(int(length), []).append(uttr)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, shuffle, rng=np.random):
+        batches = []
+        for uttrs in self.buckets.values():
+            uttrs = rng.permutation(uttrs) if shuffle else np.array(uttrs)
+            for i in range(0, len(uttrs), self.batch_size):
+                if self.drop_last and i + self.batch_size > len(uttrs):
+                    break
+                batches.append(uttrs[i:i+self.batch_size].tolist())
+        return batches
+
+    def __iter__(self):
+        rng = np.random if self.num_replicas == 1 else np.random.RandomState([self.seed, self.epoch])
+        self.epoch += 1
+        batches = self.batches(shuffle=True, rng=rng)
+        order = rng.permutation(len(batches))
+        for k in order[self.rank:len(self) * self.num_replicas:self.num_replicas]:
+            yield batches[k]
+
+    def __len__(self):
+        return len(self.batches(shuffle=False)) // self.num_replicas
+
+
+def bucket_loader(dataset, batch_size, freq, max_len_crop, **kwargs):
+    """DataLoader of whole utterances grouped by length."""
+    dataset.bucketed = True
+    dataset.freq = freq
+    dataset.max_len_crop = max_len_crop
+    sampler = BucketBatchSampler(dataset.bucket_lengths(freq, max_len_crop), batch_size,
+                                 num_replicas=get_world_size(), rank=get_rank(), seed=shared_seed())
+    if len(sampler) == 0:
+        raise ValueError(f'No length bucket holds {batch_size} utterances for each process, reduce the batch size.')
+    return data.DataLoader(dataset=dataset,
+                           sampler=sampler,
+                           batch_size=None,
+                           **kwargs)
+
+
+def get_loader(root_dir, batch_size=16, len_crop=128, num_workers=0, load_mode='eager',
+               pin_memory=False, persistent_workers=False, prefetch_factor=2, batch_crop=True,
+               bucketed=False, freq=16, max_len_crop=1024):
     """Build and return a data loader."""
 
-    dataset = Utterances(root_dir, len_crop)
+    dataset = Utterances(root_dir, len_crop, load_mode)
+    dataset.pin_memory = pin_memory
 
-    worker_init_fn = lambda x: np.random.seed((torch.initial_seed()) % (2**32))
+    kwargs = loader_kwargs(num_workers, pin_memory, persistent_workers, prefetch_factor)
+    if bucketed:
+        return bucket_loader(dataset, batch_size, freq, max_len_crop, **kwargs)
+    if batch_crop:
+        return batch_loader(dataset, batch_size, **kwargs)
     data_loader = data.DataLoader(dataset=dataset,
                                   batch_size=batch_size,
-                                  shuffle=True,
-                                  num_workers=num_workers,
+                                  sampler=speaker_sampler(dataset),
                                   drop_last=True,
-                                  worker_init_fn=worker_init_fn)
+                                  **kwargs)
     return data_loader
+
+
+class DevicePrefetcher(object):
+    """Endless iterator over a data loader, copying the next batch to the
+    device while the current one is being used."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.epoch = 0
+        self.iterator = iter(self.loader)
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            # new shuffling order, shared by the processes of data-parallel training
+            self.epoch += 1
+            sampler = self.loader.batch_sampler.sampler if self.loader.batch_sampler is not None else self.loader.sampler
+            for sampler in (sampler, getattr(sampler, 'sampler', None)):
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(self.epoch)
+            self.iterator = iter(self.loader)
+            batch = next(self.iterator)
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                batch = [x.to(self.device, non_blocking=True) for x in batch]
+        else:
+            batch = [x.to(self.device) for x in batch]
+        self.next_batch = batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.next_batch
+        if self.stream is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            for x in batch:
+                x.record_stream(torch.cuda.current_stream(self.device))
+        self.preload()
+        return batch
@@ -1,76 +1,103 @@
 from torch.utils import data
 import torch
-import tqdm
 import numpy as np
-import pickle
-import os
 
-from multiprocessing import Process, Manager
+import data_loader
+from data_loader import loader_kwargs, batch_loader, bucket_loader
+from torch_utils import get_rank, get_world_size, shared_seed
+
+
+def pair_from_index(index, num_speakers):
+    """Map an index in [0, N*(N-1)) to an ordered pair of distinct speakers."""
+    index_org = index // (num_speakers - 1)
+    index_trgt = index % (num_speakers - 1)
+    # skip the source speaker
+    index_trgt = index_trgt + (index_trgt >= index_org)
+    return index_org, index_trgt
+
+
+def index_from_pair(index_org, index_trgt, num_speakers):
+    """Inverse of pair_from_index."""
+    return index_org * (num_speakers - 1) + index_trgt - (index_trgt > index_org)
+
+
+class SpeakerPairSampler(data.Sampler):
+    """Sample (source, target) speaker pairs as indices in [0, N*(N-1)).
+
+    Each epoch covers every ordered pair exactly once, in the order of a
+    random affine permutation k -> (a*k + c) mod N*(N-1) whose pairs are then
+    relabelled by a random permutation of the speakers, both drawn from
+    (seed, epoch): a draw costs O(1) and nothing of size N*(N-1) is
+    materialized. The epoch is incremented at each pass, use set_epoch to
+    resume. In data-parallel training every process follows the same order,
+    from the same seed, and keeps every num_replicas-th pair.
+    """
+
+    def __init__(self, num_speakers, seed=None, shuffle=True, num_replicas=1, rank=0):
+        if num_speakers < 2:
+            raise ValueError('At least two speakers are needed to sample pairs.')
+        self.num_speakers = num_speakers
+        self.num_pairs = num_speakers * (num_speakers - 1)
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def permutation(self):
+        if not self.shuffle:
+            return 1, 0, np.arange(self.num_speakers)
+        rng = np.random.RandomState([self.seed, self.epoch])
+        speakers = rng.permutation(self.num_speakers)
+        while True:
+            a = int(rng.randint(1, max(self.num_pairs, 2)))
+            if np.gcd(a, self.num_pairs) == 1:
+                return a, int(rng.randint(self.num_pairs)), speakers
+
+    def __iter__(self):
+        a, c, speakers = self.permutation()
+        self.epoch += 1
+        for k in range(self.rank, len(self) * self.num_replicas, self.num_replicas):
+            index_org, index_trgt = pair_from_index((a * k + c) % self.num_pairs, self.num_speakers)
+            yield int(index_from_pair(speakers[index_org], speakers[index_trgt], self.num_speakers))
 
+    def __len__(self):
+        return self.num_pairs // self.num_replicas
 
-class Utterances(data.Dataset):
-    """Dataset class for the Utterances dataset."""
-
-    def __init__(self, root_dir, len_crop):
-        """Initialize and preprocess the Utterances dataset."""
-        self.root_dir = root_dir
-        print(root_dir)
-        self.len_crop = len_crop
-        self.step = 10
-
-        metaname = os.path.join(self.root_dir, "train.pkl")
-        meta = pickle.load(open(metaname, "rb"))
-
-        """Load data using multiprocessing"""
-        manager = Manager()
-        meta = manager.list(meta)
-        dataset = manager.list(len(meta)*[None])
-        processes = []
-        print('Loading data by batches...')
-        for i in range(0, len(meta), self.step):
-            p = Process(target=self.load_data,
-                        args=(meta[i:i+self.step],dataset,i))
-            p.start()
-            processes.append(p)
-        for p in tqdm.tqdm(processes):
-            p.join()
-
-        self.train_dataset = list(dataset)
-        self.num_tokens = len(self.train_dataset)
-
-        print(f'Finished loading the dataset...')
 
+class Utterances(data_loader.Utterances):
+    """Dataset class for the Utterances dataset, sampling pairs of speakers."""
 
-    def load_data(self, submeta, dataset, idx_offset):
-        for k, sbmt in enumerate(submeta):
-            uttrs = len(sbmt)*[None]
-            for j, tmp in enumerate(sbmt):
-                if j < 4:  # fill in speaker id and embedding
-                    uttrs[j] = tmp
-                else: # load the mel-spectrograms
-                    uttrs[j] = np.load(os.path.join(self.root_dir, tmp))
-            dataset[idx_offset+k] = uttrs
+    meta_fields = 4
 
+    def get_batch(self, indices):
+        batch_size = len(indices)
+        if self.bucketed:
+            batch, index_org = self.get_uttr_batch(indices)
+            index_trgt = (index_org + 1 + np.random.randint(self.num_tokens - 1, size=batch_size)) % self.num_tokens
+        else:
+            index_org, index_trgt = pair_from_index(np.asarray(indices), self.num_tokens)
+            batch = self.crop_batch(index_org)
+        embs = self.batch_index()['embs']
+        return batch, torch.from_numpy(embs[index_org]), torch.from_numpy(embs[index_trgt])
 
     def __getitem__(self, index):
-        # pick a random speaker
+        if isinstance(index, list):
+            # whole batch drawn by a BatchSampler
+            return self.get_batch(index)
+        # pair of speakers given by the index
         dataset = self.train_dataset
-        index_org, index_trgt = np.random.choice(range(len(dataset)), 2, replace=False)
+        index_org, index_trgt = pair_from_index(index, self.num_tokens)
         list_uttrs_org, list_uttrs_trgt = dataset[index_org], dataset[index_trgt]
         emb_org = list_uttrs_org[1]
         emb_trgt = list_uttrs_trgt[1]
 
         # pick random uttr with random crop
-        a = np.random.randint(4, len(list_uttrs_org))
-        tmp = list_uttrs_org[a]
-        if tmp.shape[0] < self.len_crop:
-            len_pad = self.len_crop - tmp.shape[0]
-            uttr = np.pad(tmp, ((0,len_pad),(0,0)), 'constant')
-        elif tmp.shape[0] > self.len_crop:
-            left = np.random.randint(tmp.shape[0]-self.len_crop)
-            uttr = tmp[left:left+self.len_crop, :]
-        else:
-            uttr = tmp
+        a = np.random.randint(self.meta_fields, len(list_uttrs_org))
+        uttr = self.crop(self.get_mel(list_uttrs_org[a]))
 
         return uttr, emb_org, emb_trgt
 
@@ -81,16 +108,24 @@ class Utterances(data.Dataset):
 
 
 
-def get_loader(root_dir, batch_size=16, len_crop=128, num_workers=0):
+def get_loader(root_dir, batch_size=16, len_crop=128, num_workers=0, load_mode='eager',
+               pin_memory=False, persistent_workers=False, prefetch_factor=2, batch_crop=True,
+               bucketed=False, freq=16, max_len_crop=1024, pair_seed=None):
     """Build and return a data loader."""
 
-    dataset = Utterances(root_dir, len_crop)
+    dataset = Utterances(root_dir, len_crop, load_mode)
+    dataset.pin_memory = pin_memory
 
-    worker_init_fn = lambda x: np.random.seed((torch.initial_seed()) % (2**32))
+    kwargs = loader_kwargs(num_workers, pin_memory, persistent_workers, prefetch_factor)
+    if bucketed:
+        return bucket_loader(dataset, batch_size, freq, max_len_crop, **kwargs)
+    sampler = SpeakerPairSampler(dataset.num_tokens, seed=shared_seed(pair_seed),
+                                 num_replicas=get_world_size(), rank=get_rank())
+    if batch_crop:
+        return batch_loader(dataset, batch_size, sampler=sampler, **kwargs)
     data_loader = data.DataLoader(dataset=dataset,
                                   batch_size=batch_size,
-                                  shuffle=True,
-                                  num_workers=num_workers,
+                                  sampler=sampler,
                                   drop_last=True,
-                                  worker_init_fn=worker_init_fn)
+                                  **kwargs)
     return data_loader
@@ -0,0 +1,113 @@
+"""
+Compact storage of the speaker embeddings of a dataset
+
+The embeddings are the rows of a single float32 matrix saved as .npy, read
+through np.memmap, and an index maps each speaker name to its row. Loading
+does not depend on the number of utterances of the corpus, unlike train.pkl.
+The store of a metadata file is saved next to it: train.pkl has
+train_embs.npy and its index train_embs.pkl.
+"""
+import os
+import pickle
+import argparse
+import numpy as np
+
+
+def store_paths(metadata_path):
+    """(embeddings, index) paths of the store of a metadata file."""
+    stem = os.path.splitext(metadata_path)[0]
+    return stem + '_embs.npy', stem + '_embs.pkl'
+
+
+def write_embeddings(metadata_path, names, embs):
+    """Save the (len(names), dim_emb) embeddings of metadata_path, replacing
+    any previous store. Write the store after the metadata file, a store
+    older than its metadata is considered stale."""
+    embs = np.ascontiguousarray(embs, dtype=np.float32)
+    assert embs.ndim == 2 and embs.shape[0] == len(names)
+    embs_path, index_path = store_paths(metadata_path)
+    with open(embs_path + '.tmp', 'wb') as handle:
+        np.save(handle, embs)
+    with open(index_path + '.tmp', 'wb') as handle:
+        pickle.dump(list(names), handle)
+    os.replace(embs_path + '.tmp', embs_path)
+    os.replace(index_path + '.tmp', index_path)
+
+
+class EmbeddingStore(object):
+    """Dict-style access to speaker embeddings, with nearest-neighbour search."""
+
+    def __init__(self, names, embs):
+        self.names = list(names)
+        self.embs = embs
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self._unit = None
+
+    @classmethod
+    def load(cls, metadata_path, mmap=True):
+        embs_path, index_path = store_paths(metadata_path)
+        with open(index_path, 'rb') as handle:
+            names = pickle.load(handle)
+        embs = np.load(embs_path, mmap_mode='r' if mmap else None)
+        return cls(names, embs)
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Build the store of a train.pkl list ([speaker, embedding, utterances...])."""
+        names = [sbmt[0] for sbmt in metadata]
+        embs = np.stack([sbmt[1] for sbmt in metadata]).astype(np.float32) if metadata else np.zeros((0, 0), np.float32)
+        return cls(names, embs)
+
+    @staticmethod
+    def exists(metadata_path):
+        """Whether metadata_path has a store, at least as recent as itself."""
+        embs_path, index_path = store_paths(metadata_path)
+        if not (os.path.isfile(embs_path) and os.path.isfile(index_path)):
+            return False
+        if not os.path.isfile(metadata_path):
+            return True
+        return min(os.stat(embs_path).st_mtime_ns, os.stat(index_path).st_mtime_ns) \
+            >= os.stat(metadata_path).st_mtime_ns
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        """(dim_emb,) embedding of a speaker."""
+        return self.embs[self.rows[name]]
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def nearest(self, emb, k=5):
+        """The k speakers closest to emb by cosine similarity, as (name, similarity) pairs."""
+        if self._unit is None:
+            embs = np.asarray(self.embs, dtype=np.float32)
+            self._unit = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+        emb = np.asarray(emb, dtype=np.float32).reshape(-1)
+        similarity = self._unit @ (emb / max(np.linalg.norm(emb), 1e-12))
+        k = min(k, len(self.names))
+        best = np.argpartition(-similarity, k - 1)[:k] if k > 0 else []
+        best = sorted(best, key=lambda row: -similarity[row])
+        return [(self.names[row], float(similarity[row])) for row in best]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the speakers closest to a speaker')
+    parser.add_argument('speaker', type=str)
+    parser.add_argument('--metadata', type=str, default='./training_set/spmel/train.pkl')
+    parser.add_argument('--k', type=int, default=5)
+    config = parser.parse_args()
+
+    if EmbeddingStore.exists(config.metadata):
+        store = EmbeddingStore.load(config.metadata)
+    else:
+        with open(config.metadata, 'rb') as handle:
+            store = EmbeddingStore.from_metadata(pickle.load(handle))
+    neighbours = [(name, similarity) for name, similarity in store.nearest(store[config.speaker], config.k + 1)
+                  if name != config.speaker]
+    for name, similarity in neighbours[:config.k]:
+        print(f'{name}\t{similarity:.4f}')
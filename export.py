@@ -0,0 +1,72 @@
+"""
+Export a trained Generator as a standalone TorchScript inference model
+
+The BatchNorm layers are folded into the ConvNorm convolutions that precede
+them and the network is traced, unrolling the convolution loops. The archive
+holds the whole model, so converter can load it without model_vc:
+
+    python export.py --model autovc.ckpt --output autovc.ts
+    python converter.py --model autovc.ts --source='p225/p225_003.wav' --target='p228'
+"""
+import argparse
+import copy
+import zipfile
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from model_vc import ConvNorm
+
+
+def fold_batchnorm(G):
+    """Copy of the Generator in eval mode whose (ConvNorm, BatchNorm1d) layers
+    are replaced by a single ConvNorm computing the same function."""
+    G = copy.deepcopy(G).eval()
+    for convolutions in (G.encoder.convolutions, G.decoder.convolutions, G.postnet.convolutions):
+        for k, layer in enumerate(convolutions):
+            if isinstance(layer, nn.Sequential) and len(layer) == 2 and \
+                    isinstance(layer[0], ConvNorm) and isinstance(layer[1], nn.BatchNorm1d):
+                layer[0].conv = fuse_conv_bn_eval(layer[0].conv, layer[1])
+                convolutions[k] = layer[0]
+    return G
+
+
+def export_generator(G, path=None, num_frames=128):
+    """Trace the folded Generator for inference and save it to path, if any.
+
+    The trace is checked against the eager model on another batch size and
+    length, the model being traced for any (batch, num_frames, 80) input
+    whose length is a multiple of the code frequency.
+    """
+    G = fold_batchnorm(G)
+    parameter = next(G.parameters())
+    dim_emb = G.encoder.convolutions[0].conv.in_channels - 80
+    x = torch.rand(1, num_frames, 80, device=parameter.device)
+    emb = torch.rand(1, dim_emb, device=parameter.device)
+    with torch.no_grad():
+        traced = torch.jit.trace(G, (x, emb, emb))
+        x = torch.rand(2, 2 * num_frames, 80, device=parameter.device)
+        emb = torch.rand(2, dim_emb, device=parameter.device)
+        for a, b in zip(G(x, emb, emb), traced(x, emb, emb)):
+            torch.testing.assert_close(a, b)
+    if path is not None:
+        traced.save(path)
+    return traced
+
+
+def is_torchscript(path):
+    """Whether path is a TorchScript archive rather than a training checkpoint."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any('/code/' in name for name in archive.namelist())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='autovc.ckpt', help='trained Generator checkpoint')
+    parser.add_argument('--output', type=str, default='autovc.ts')
+    config = parser.parse_args()
+
+    from converter import load_generator
+    export_generator(load_generator(config.model).cpu(), config.output)
+    print(f'TorchScript generator saved at {config.output}')
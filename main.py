@@ -3,7 +3,7 @@ import argparse
 from solver_encoder import Solver
 from data_loader import get_loader
 from torch.backends import cudnn
-from torch_utils import device
+from torch_utils import device, init_distributed, cleanup_distributed
 
 def str2bool(v):
     return v.lower() in ('true')
@@ -11,14 +11,22 @@ def str2bool(v):
 def main(config):
     # For fast training.
     cudnn.benchmark = True
+    # Data-parallel training when launched by torchrun, each process training
+    # on its share of the speakers.
+    init_distributed(config.dist_backend)
 
     # Data loader.
-    vcc_loader = get_loader(config.dataset + '/spmel', config.batch_size, config.len_crop)
+    vcc_loader = get_loader(config.dataset + '/spmel', config.batch_size, config.len_crop,
+                            num_workers=config.num_workers, load_mode=config.load_mode,
+                            pin_memory=config.pin_memory, persistent_workers=config.persistent_workers,
+                            prefetch_factor=config.prefetch_factor, batch_crop=config.batch_crop,
+                            bucketed=config.bucketed, freq=config.freq, max_len_crop=config.max_len_crop)
 
     solver = Solver(vcc_loader, config)
 
     solver.train()
     solver.save_model(config.dataset + '/' + config.checkpoint)
+    cleanup_distributed()
 
 
 
@@ -45,12 +53,28 @@ if __name__ == '__main__':
     # Training configuration.
     parser.add_argument('--dataset', type=str, default="training_set", help='dataset dir')
     parser.add_argument('--batch_size', type=int, default=2, help='mini-batch size')
+    parser.add_argument('--grad_accum_steps', type=int, default=1,
+                        help='mini-batches whose gradients are accumulated per optimization step (effective batch: batch_size * grad_accum_steps)')
     parser.add_argument('--num_iters', type=int, default=10, help='number of total iterations')
     parser.add_argument('--len_crop', type=int, default=128, help='dataloader output sequence length')
+    parser.add_argument('--load_mode', type=str, default='eager', choices=['eager', 'lazy'],
+                        help='load every spectrogram at startup or read the crops from disk on the fly')
+    parser.add_argument('--num_workers', type=int, default=2, help='number of data loading processes')
+    parser.add_argument('--pin_memory', type=str2bool, default=device != 'cpu', help='use page-locked host memory for the batches')
+    parser.add_argument('--persistent_workers', type=str2bool, default=True, help='keep the loading processes alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='number of batches loaded in advance by each worker')
+    parser.add_argument('--batch_crop', type=str2bool, default=True, help='crop and collate whole batches at once')
+    parser.add_argument('--bucketed', type=str2bool, default=False,
+                        help='train on whole utterances batched by length (multiple of freq) instead of len_crop crops')
+    parser.add_argument('--max_len_crop', type=int, default=1024, help='maximum sequence length in bucketed mode')
     print('use device: ', device)
     # Miscellaneous.
     parser.add_argument('--log_step', type=int, default=100)
     parser.add_argument('--learning_rate', type=float, default=0.0001)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='mixed-precision training mode (bf16 also runs on CPU)')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'],
+                        help='communication backend of data-parallel training (torchrun --nproc_per_node=N main.py)')
 
     config = parser.parse_args()
     print(config)
@@ -3,7 +3,7 @@ import argparse
 from solver_encoder_circular import Solver
 from data_loader_circular import get_loader
 from torch.backends import cudnn
-from torch_utils import device
+from torch_utils import device, init_distributed, cleanup_distributed
 
 def str2bool(v):
     return v.lower() in ('true')
@@ -11,14 +11,23 @@ def str2bool(v):
 def main(config):
     # For fast training.
     cudnn.benchmark = True
+    # Data-parallel training when launched by torchrun, each process training
+    # on its share of the speakers.
+    init_distributed(config.dist_backend)
 
     # Data loader.
-    vcc_loader = get_loader(config.dataset + '/spmel', config.batch_size, config.len_crop)
+    vcc_loader = get_loader(config.dataset + '/spmel', config.batch_size, config.len_crop,
+                            num_workers=config.num_workers, load_mode=config.load_mode,
+                            pin_memory=config.pin_memory, persistent_workers=config.persistent_workers,
+                            prefetch_factor=config.prefetch_factor, batch_crop=config.batch_crop,
+                            bucketed=config.bucketed, freq=config.freq, max_len_crop=config.max_len_crop,
+                            pair_seed=config.pair_seed)
 
     solver = Solver(vcc_loader, config)
 
     solver.train()
     solver.save_model(config.dataset + '/' + config.checkpoint)
+    cleanup_distributed()
 
 
 
@@ -34,6 +43,11 @@ if __name__ == '__main__':
     parser.add_argument('--freq', type=int, default=16)
     parser.add_argument('--init_model', type=str, default='')
     parser.add_argument('--use_speaker_loss', type=int, default=1)
+    parser.add_argument('--speaker_encoder', type=str, default='3000000-BL.ckpt', help='frozen speaker encoder of the style loss')
+    parser.add_argument('--speaker_loss_every', type=int, default=1, help='compute the style loss every k steps')
+    parser.add_argument('--speaker_loss_precision', type=str, default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='precision of the speaker encoder (default: --precision)')
+    parser.add_argument('--time_speaker_loss', type=str2bool, default=False, help='log the share of the step time spent on the style loss')
 
     # Checkpoint path
     parser.add_argument('--checkpoint', type=str, default='autovc.ckpt')
@@ -46,12 +60,29 @@ if __name__ == '__main__':
     # Training configuration.
     parser.add_argument('--dataset', type=str, default="training_set", help='dataset dir')
     parser.add_argument('--batch_size', type=int, default=2, help='mini-batch size')
+    parser.add_argument('--grad_accum_steps', type=int, default=1,
+                        help='mini-batches whose gradients are accumulated per optimization step (effective batch: batch_size * grad_accum_steps)')
     parser.add_argument('--num_iters', type=int, default=10, help='number of total iterations')
     parser.add_argument('--len_crop', type=int, default=128, help='dataloader output sequence length')
+    parser.add_argument('--load_mode', type=str, default='eager', choices=['eager', 'lazy'],
+                        help='load every spectrogram at startup or read the crops from disk on the fly')
+    parser.add_argument('--num_workers', type=int, default=2, help='number of data loading processes')
+    parser.add_argument('--pin_memory', type=str2bool, default=device != 'cpu', help='use page-locked host memory for the batches')
+    parser.add_argument('--persistent_workers', type=str2bool, default=True, help='keep the loading processes alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='number of batches loaded in advance by each worker')
+    parser.add_argument('--batch_crop', type=str2bool, default=True, help='crop and collate whole batches at once')
+    parser.add_argument('--bucketed', type=str2bool, default=False,
+                        help='train on whole utterances batched by length (multiple of freq) instead of len_crop crops')
+    parser.add_argument('--max_len_crop', type=int, default=1024, help='maximum sequence length in bucketed mode')
+    parser.add_argument('--pair_seed', type=int, default=None, help='seed of the order of the (source, target) speaker pairs')
     print('use device: ', device)
     # Miscellaneous.
     parser.add_argument('--log_step', type=int, default=100)
     parser.add_argument('--learning_rate', type=float, default=0.0001)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='mixed-precision training mode (bf16 also runs on CPU)')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'],
+                        help='communication backend of data-parallel training (torchrun --nproc_per_node=N main.py)')
 
     config = parser.parse_args()
     print(config)
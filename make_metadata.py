@@ -9,13 +9,19 @@ import numpy as np
 import torch
 from torch_utils import device
 import argparse
+from spect_store import SpectStore
+from embedding_store import write_embeddings
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from make_spect import load_manifest as load_spect_manifest
+import zlib
 
-def load_speaker_embedding_model():
+def load_speaker_embedding_model(checkpoint_path='3000000-BL.ckpt'):
     C = D_VECTOR(dim_input=80, dim_cell=768, dim_emb=256).to(device)
     if torch.cuda.is_available():
-        c_checkpoint = torch.load('3000000-BL.ckpt')
+        c_checkpoint = torch.load(checkpoint_path)
     else:
-        c_checkpoint = torch.load('3000000-BL.ckpt', map_location=torch.device('cpu'))
+        c_checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
     new_state_dict = OrderedDict()
     for key, val in c_checkpoint['model_b'].items():
         new_key = key[7:]
@@ -24,56 +30,220 @@ def load_speaker_embedding_model():
     return C
 
 
-def make_metadata(dataset_dir = 'training_set'):
+PARTIAL_NAME = 'train.pkl.partial'
+MANIFEST_NAME = 'metadata_manifest.pkl'
+
+
+def speaker_crops(fileList, load_mel, num_uttrs=10, len_crop=128, prng=np.random):
+    """(num_uttrs, len_crop, n_mels) random crops of distinct utterances of a
+    speaker, replacing the utterances shorter than len_crop."""
+    idx_uttrs = prng.choice(len(fileList), size=num_uttrs, replace=False)
+    candidates = np.delete(np.arange(len(fileList)), idx_uttrs)
+    crops = []
+    for i in range(num_uttrs):
+        tmp = load_mel(fileList[idx_uttrs[i]])
+        # choose another utterance if the current one is too short
+        while tmp.shape[0] < len_crop:
+            idx_alt = prng.choice(candidates)
+            tmp = load_mel(fileList[idx_alt])
+            candidates = np.delete(candidates, np.argwhere(candidates==idx_alt))
+        left = prng.randint(0, tmp.shape[0]-len_crop+1)
+        crops.append(tmp[left:left+len_crop, :])
+    return np.stack(crops)
+
+
+def speaker_prng(seed, speaker):
+    """Random generator of the crops of a speaker, independent of the other
+    speakers and of the processing order."""
+    return np.random.RandomState([seed, zlib.crc32(speaker.encode())])
+
+
+def load_partial(partial_path, params):
+    """Speakers already processed by an interrupted run with the same params,
+    as {speaker: (signature, utterances)}, dropping a truncated last record.
+
+    The file starts with the params of the run that wrote it, followed by a
+    (signature, utterances) record per speaker.
+    """
+    done = OrderedDict()
+    if not os.path.isfile(partial_path):
+        return done
+    with open(partial_path, 'r+b') as handle:
+        try:
+            previous = pickle.load(handle)
+        except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError, TypeError):
+            previous = None
+        if previous != params:
+            if previous is not None:
+                print('Embedding parameters changed, discarding the interrupted run.')
+            handle.truncate(0)
+            return done
+        position = handle.tell()
+        while True:
+            try:
+                signature, utterances = pickle.load(handle)
+            except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError, TypeError):
+                break
+            done[utterances[0]] = (signature, utterances)
+            position = handle.tell()
+        handle.truncate(position)
+    return done
+
+
+def load_manifest(rootDir, params):
+    """{speaker: signature} of the speakers of train.pkl, if it was computed
+    with the same params."""
+    manifest_path = os.path.join(rootDir, MANIFEST_NAME)
+    if os.path.isfile(manifest_path) and os.path.isfile(os.path.join(rootDir, 'train.pkl')):
+        with open(manifest_path, 'rb') as handle:
+            manifest = pickle.load(handle)
+        if manifest.get('params') == params:
+            return manifest['speakers']
+        print('Embedding parameters changed, recomputing every speaker.')
+    return {}
+
+
+def save_metadata(rootDir, params, speakers, signatures):
+    """Atomically replace train.pkl, the embedding store and the manifest."""
+    metadata_path = os.path.join(rootDir, 'train.pkl')
+    with open(metadata_path + '.tmp', 'wb') as handle:
+        pickle.dump(speakers, handle)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    # speaker embeddings alone, for fast lookup at conversion time
+    write_embeddings(metadata_path, [sbmt[0] for sbmt in speakers],
+                     np.stack([sbmt[1] for sbmt in speakers]) if speakers else np.zeros((0, 256)))
+    manifest_path = os.path.join(rootDir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'wb') as handle:
+        pickle.dump({'params': params, 'speakers': signatures}, handle)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def make_metadata(dataset_dir = 'training_set', num_workers=cpu_count(), batch_size=320, resume=True,
+                  seed=0, encoder_ckpt='3000000-BL.ckpt'):
+    """Write train.pkl, the speaker embedding and the utterances of every
+    speaker, and the embedding store.
+
+    Only the speakers whose utterances changed since the last run, according
+    to metadata_manifest.pkl, are embedded again; the others are kept from
+    the existing train.pkl. Crops are drawn by a generator seeded by seed and
+    the speaker name, so an unchanged speaker always gets the same embedding.
+    Crops are loaded by num_workers threads and embedded by batches of about
+    batch_size crops from many speakers. Each batch of speakers is appended
+    to train.pkl.partial, from which an interrupted run resumes.
+    """
 
     num_uttrs = 10
     len_crop = 128
-
-    C = load_speaker_embedding_model().eval()
+    params = {
+        'num_uttrs': num_uttrs,
+        'len_crop': len_crop,
+        'seed': seed,
+        'encoder': (os.path.abspath(encoder_ckpt), os.path.getmtime(encoder_ckpt)),
+    }
 
     # Directory containing mel-spectrograms
     rootDir = dataset_dir + '/spmel'
-    dirName, subdirList, _ = next(os.walk(rootDir))
-    print('Found directory: %s' % dirName)
+    if SpectStore.exists(rootDir):
+        store = SpectStore(rootDir)
+        print('Found packed spectrograms: %s' % rootDir)
+        subdirList = list(store.speakers)
+        load_mel = lambda fileName: np.array(store[fileName], dtype=np.float32)
+        # source wav of each spectrogram, as recorded by make_spect
+        spect_manifest = {entry[2].replace('\\', '/') + '.npy': entry[:2] for entry in load_spect_manifest(rootDir).values()}
+        signature = lambda fileName: (fileName, store.utterances[fileName][1], spect_manifest.get(fileName))
+    else:
+        store = None
+        dirName, subdirList, _ = next(os.walk(rootDir))
+        print('Found directory: %s' % dirName)
+        load_mel = np.load
+
+        def signature(fileName):
+            stat = os.stat(fileName)
+            return (os.path.relpath(fileName, rootDir).replace('\\', '/'), stat.st_size, stat.st_mtime_ns)
 
     print(subdirList)
-    speakers = []
+    partial_path = os.path.join(rootDir, PARTIAL_NAME)
+    if not resume and os.path.isfile(partial_path):
+        os.remove(partial_path)
+    previous = load_manifest(rootDir, params) if resume else {}
+    if previous:
+        with open(os.path.join(rootDir, 'train.pkl'), 'rb') as handle:
+            existing = {sbmt[0]: sbmt for sbmt in pickle.load(handle)}
+    else:
+        existing = {}
+    partial = load_partial(partial_path, params)
+    if partial:
+        print(f'Resuming after {len(partial)} speakers')
+
+    done = {}
+    signatures = {}
+    jobs = []
     for speaker in sorted(subdirList):
-        print('Processing speaker: %s' % speaker)
-        utterances = []
-        utterances.append(speaker)
         fileList = []
-        for root, _, files in os.walk(os.path.join(dirName,speaker)):
-            for fileName in files:
-                fileList.append(os.path.join(root,fileName))
-        # make speaker embedding
+        if store is not None:
+            fileList = list(store.speakers[speaker])
+        else:
+            for root, _, files in os.walk(os.path.join(dirName,speaker)):
+                for fileName in files:
+                    fileList.append(os.path.join(root,fileName))
         if len(fileList) < num_uttrs:
             print(f'Could not process speaker {speaker} : not enough files were found ({len(fileList)})')
             continue
-        idx_uttrs = np.random.choice(len(fileList), size=num_uttrs, replace=False)
-        embs = []
-        for i in range(num_uttrs):
-            tmp = np.load(os.path.join(fileList[idx_uttrs[i]]))
-            candidates = np.delete(np.arange(len(fileList)), idx_uttrs)
-            # choose another utterance if the current one is too short
-            while tmp.shape[0] < len_crop:
-                idx_alt = np.random.choice(candidates)
-                tmp = np.load(os.path.join(dirName, speaker, fileList[idx_alt]))
-                candidates = np.delete(candidates, np.argwhere(candidates==idx_alt))
-            left = np.random.randint(0, tmp.shape[0]-len_crop)
-            melsp = torch.from_numpy(tmp[np.newaxis, left:left+len_crop, :]).to(device)
-            emb = C(melsp)
-            embs.append(emb.detach().squeeze().cpu().numpy())
-        utterances.append(np.mean(embs, axis=0))
-
-        # create file list
-        for fileName in sorted(fileList):
-            fileName = fileName.replace('\\', '/')
-            utterances.append('/'.join(fileName.split('/')[-2:]))
-        speakers.append(utterances)
-
-    with open(os.path.join(rootDir, 'train.pkl'), 'wb') as handle:
-        pickle.dump(speakers, handle)
+        fileList = sorted(fileList)
+        signatures[speaker] = tuple(signature(fileName) for fileName in fileList)
+        # skip the speakers whose utterances did not change
+        if previous.get(speaker) == signatures[speaker] and speaker in existing:
+            done[speaker] = existing[speaker]
+        elif speaker in partial and partial[speaker][0] == signatures[speaker]:
+            done[speaker] = partial[speaker][1]
+        else:
+            jobs.append((speaker, fileList))
+
+    print(f'{len(done)} speakers up to date, {len(jobs)} to compute.')
+    if not jobs and set(done) == set(existing):
+        if os.path.isfile(partial_path):
+            os.remove(partial_path)
+        return
+
+    def load_job(job):
+        speaker, fileList = job
+        crops = speaker_crops(fileList, load_mel, num_uttrs, len_crop, speaker_prng(seed, speaker))
+        return speaker, fileList, crops
+
+    def embed(batch, handle):
+        crops = torch.from_numpy(np.concatenate([crops for _, _, crops in batch])).to(device)
+        with torch.inference_mode():
+            embs = C(crops).float().cpu().numpy().reshape(len(batch), num_uttrs, -1).mean(axis=1)
+        for (speaker, fileList, _), emb in zip(batch, embs):
+            utterances = [speaker, emb]
+            # create file list
+            for fileName in fileList:
+                fileName = fileName.replace('\\', '/')
+                utterances.append('/'.join(fileName.split('/')[-2:]))
+            pickle.dump((signatures[speaker], utterances), handle)
+            done[speaker] = utterances
+        handle.flush()
+
+    if jobs:
+        C = load_speaker_embedding_model(encoder_ckpt).eval()
+        speakers_per_batch = max(1, batch_size // num_uttrs)
+        with ThreadPool(num_workers) as pool, open(partial_path, 'ab') as handle:
+            if handle.tell() == 0:
+                pickle.dump(params, handle)
+            batch = []
+            for speaker, fileList, crops in pool.imap(load_job, jobs):
+                print('Processing speaker: %s' % speaker)
+                batch.append((speaker, fileList, crops))
+                if len(batch) == speakers_per_batch:
+                    embed(batch, handle)
+                    batch = []
+            if batch:
+                embed(batch, handle)
+
+    speakers = [done[speaker] for speaker in sorted(done)]
+    save_metadata(rootDir, params, speakers, {speaker: signatures[speaker] for speaker in done})
+    if os.path.isfile(partial_path):
+        os.remove(partial_path)
 
 
 if __name__ == '__main__':
@@ -81,5 +251,11 @@ if __name__ == '__main__':
 
     # dataset dir
     parser.add_argument('--dataset', type=str, default="voxceleb", help='dataset dir')
+    parser.add_argument('--num_workers', type=int, default=cpu_count(), help='number of spectrogram loading threads')
+    parser.add_argument('--batch_size', type=int, default=320, help='number of crops embedded at once')
+    parser.add_argument('--force', action='store_true', help='recompute every speaker instead of only the changed ones')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the choice of the crops')
+    parser.add_argument('--encoder', type=str, default='3000000-BL.ckpt', help='speaker encoder checkpoint')
     config = parser.parse_args()
-    make_metadata(config.dataset)
+    make_metadata(config.dataset, config.num_workers, config.batch_size, resume=not config.force,
+                  seed=config.seed, encoder_ckpt=config.encoder)
@@ -1,65 +1,84 @@
 import os
 import pickle
+import time
 import numpy as np
 import soundfile as sf
-from scipy import signal
-from scipy.signal import get_window
-from librosa.filters import mel
-from librosa.core import load
 import matplotlib.pyplot as plt
-from numpy.random import RandomState
 import argparse
 import tqdm
+from melspec import MelSpectrogram
+from spect_store import SpectStore, SpectStoreWriter
+from multiprocessing import Pool, cpu_count
 
 
-def butter_highpass(cutoff, fs, order=5):
-    nyq = 0.5 * fs
-    normal_cutoff = cutoff / nyq
-    b, a = signal.butter(order, normal_cutoff, btype='high', analog=False)
-    return b, a
+def to_specs(jobs, extractor):
+    """Extract and save a batch of (wav_path, target_path) jobs at once."""
+    specs = extractor.from_files([wav_path for wav_path, _ in jobs])
+    for (_, target_path), S in zip(jobs, specs):
+        np.save(target_path, S, allow_pickle=False)
+    return sum(S.shape[0] for S in specs)
 
 
-def pySTFT(x, fft_length=1024, hop_length=256):
+# Parameters the spectrograms depend on, recorded in the manifest so that a
+# change of any of them invalidates the previously extracted files.
+SPEC_PARAMS = {
+    'sr': 16000,
+    'fft_length': 1024,
+    'hop_length': 256,
+    'fmin': 90,
+    'fmax': 7600,
+    'n_mels': 80,
+    'cutoff': 30,
+    'order': 5,
+    'min_level_db': -100,
+}
 
-    x = np.pad(x, int(fft_length//2), mode='reflect')
+MANIFEST_NAME = 'manifest.pkl'
 
-    noverlap = fft_length - hop_length
-    shape = x.shape[:-1]+((x.shape[-1]-noverlap)//hop_length, fft_length)
-    strides = x.strides[:-1]+(hop_length*x.strides[-1], x.strides[-1])
-    result = np.lib.stride_tricks.as_strided(x, shape=shape,
-                                             strides=strides)
 
-    fft_window = get_window('hann', fft_length, fftbins=True)
-    result = np.fft.rfft(fft_window * result, n=fft_length).T
+def spect_format(packed, dtype):
+    """Output format recorded in the manifest: ('npy', 'float32') or ('packed', dtype)."""
+    return ('packed', np.dtype(dtype).name) if packed else ('npy', 'float32')
 
-    return np.abs(result)
 
+def load_manifest(targetDir, output_format=None):
+    """Entries of the previous run, if it used the same parameters and, when
+    given, the same output format."""
+    manifest_path = os.path.join(targetDir, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'rb') as handle:
+            manifest = pickle.load(handle)
+        if manifest.get('params') != SPEC_PARAMS:
+            print('Extraction parameters changed, recomputing every spectrogram.')
+        elif output_format is not None and manifest.get('format') != output_format:
+            print('Output format changed, recomputing every spectrogram.')
+        else:
+            return manifest['files']
+    return {}
 
-def to_spec(wav_path, target_path,a, b, mel_basis, min_level):
-    prng = RandomState(1)
-    # Read audio file
-    x, fs = load(wav_path, mono=True, sr=16000)
-    # Remove drifting noise
-    y = signal.filtfilt(b, a, x)
 
-    # Ddd a little random noise for model roubstness
-    wav = y * 0.96 + (prng.rand(y.shape[0])-0.5)*1e-06
-    # Compute spect
-    D = pySTFT(wav).T
-    # Convert to mel and normalize
-    D_mel = np.dot(D, mel_basis)
-    D_db = 20 * np.log10(np.maximum(min_level, D_mel)) - 16
-    S = np.clip((D_db + 100) / 100, 0, 1)
-    # save spect
-    np.save(target_path, S.astype(np.float32), allow_pickle=False)
+def save_manifest(targetDir, files, output_format):
+    manifest_path = os.path.join(targetDir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'wb') as handle:
+        pickle.dump({'params': SPEC_PARAMS, 'format': output_format, 'files': files}, handle)
+    os.replace(manifest_path + '.tmp', manifest_path)
 
 
+_extractor = None
 
-def make_spec(datasetDir = "training_set"):
-    mel_basis = mel(16000, 1024, fmin=90, fmax=7600, n_mels=80).T
-    min_level = np.exp(-100 / 20 * np.log(10))
-    b, a = butter_highpass(30, 16000, order=5)
+def _init_worker(backend):
+    global _extractor
+    _extractor = MelSpectrogram(backend=backend, **SPEC_PARAMS)
 
+def _to_specs_job(jobs):
+    return jobs, to_specs(jobs, _extractor)
+
+def _extract_job(jobs):
+    return jobs, _extractor.from_files([wav_path for wav_path, _ in jobs])
+
+
+def make_spec(datasetDir = "training_set", num_workers=1, force=False, batch_size=16, backend='numpy',
+              packed=False, dtype='float32'):
 
     # audio file directory
     rootDir = datasetDir + '/wavs'
@@ -69,22 +88,134 @@ def make_spec(datasetDir = "training_set"):
     if not os.path.exists(targetDir):
         os.mkdir(targetDir)
 
+    output_format = spect_format(packed, dtype)
+    previous = {} if force else load_manifest(targetDir, output_format)
+    if not packed:
+        # the readers prefer a packed store to the .npy files
+        SpectStore.remove(targetDir)
+    packed_keys = set(SpectStore(targetDir).keys()) if packed and SpectStore.exists(targetDir) else set()
+    manifest = {}
+    jobs = []
+    targets = set()
     dirs= os.listdir(rootDir)
-    print('Processing speakers :')
+    print('Scanning speakers :')
     for speaker in tqdm.tqdm(dirs):
         rootDirName = f"{rootDir}/{speaker}/"
         targetDirName = f"{targetDir}/{speaker}/"
-        if not os.path.exists(targetDirName):
+        if not packed and not os.path.exists(targetDirName):
             os.mkdir(targetDirName)
         for dirName, dirs, files in os.walk(rootDirName):
             subfolder = ''
             if len(dirName.split('/')):
                 subfolder = dirName.split('/')[-1]
             for fileName in files:
-                #if os.path.exists(os.path.join(targetDirName, subfolder+fileName[:-4]+'.npy')):
-                    #continue
-                #prng = RandomState(int(subdir[1:]))
-                to_spec(os.path.join(dirName,fileName), os.path.join(targetDirName, subfolder+fileName[:-4]),a, b, mel_basis, min_level)
+                wav_path = os.path.join(dirName, fileName)
+                target_path = os.path.join(targetDirName, subfolder+fileName[:-4])
+                stat = os.stat(wav_path)
+                key = os.path.relpath(wav_path, rootDir).replace('\\', '/')
+                entry = (stat.st_size, stat.st_mtime_ns, os.path.relpath(target_path, targetDir))
+                targets.add(os.path.normpath(target_path + '.npy'))
+                if packed:
+                    extracted = entry[2] + '.npy' in packed_keys
+                else:
+                    extracted = os.path.exists(target_path + '.npy')
+                # skip files already extracted with the same parameters
+                if previous.get(key) == entry and extracted:
+                    manifest[key] = entry
+                    continue
+                jobs.append((key, entry, wav_path, target_path))
+
+    if not packed:
+        remove_stale(targetDir, targets)
+    print(f'{len(manifest)} spectrograms up to date, {len(jobs)} to compute.')
+    # group the files so that each extraction call handles several utterances
+    batches = [[(wav_path, target_path) for _, _, wav_path, target_path in jobs[i:i+batch_size]]
+               for i in range(0, len(jobs), batch_size)]
+    pending = {(wav_path, target_path): (key, entry) for key, entry, wav_path, target_path in jobs}
+    num_frames = 0
+    start_time = time.time()
+    try:
+        if packed:
+            num_frames = make_packed(targetDir, manifest, batches, pending,
+                                     num_workers, backend, dtype)
+        elif num_workers > 1:
+            with Pool(num_workers, initializer=_init_worker, initargs=(backend,)) as pool:
+                for done, frames in tqdm.tqdm(pool.imap_unordered(_to_specs_job, batches),
+                                              total=len(batches)):
+                    num_frames += frames
+                    manifest.update(pending[job] for job in done)
+        else:
+            extractor = MelSpectrogram(backend=backend, **SPEC_PARAMS)
+            for batch in tqdm.tqdm(batches):
+                num_frames += to_specs(batch, extractor)
+                manifest.update(pending[job] for job in batch)
+    finally:
+        # keep track of what was done even if the run is interrupted
+        save_manifest(targetDir, manifest, output_format)
+    if num_frames:
+        print(f'Extracted {num_frames} frames at {num_frames / (time.time() - start_time):.0f} frames/s.')
+
+
+def remove_stale(targetDir, targets):
+    """Delete the .npy spectrograms of the speaker directories of targetDir
+    whose wav file is gone, and the speaker directories left empty, so that
+    make_metadata does not pick them up."""
+    removed = 0
+    targetDirs = {os.path.dirname(path) for path in targets}
+    for speaker in os.listdir(targetDir):
+        speakerDir = os.path.join(targetDir, speaker)
+        if not os.path.isdir(speakerDir):
+            continue
+        for dirName, _, files in os.walk(speakerDir, topdown=False):
+            for fileName in files:
+                path = os.path.normpath(os.path.join(dirName, fileName))
+                if fileName.endswith('.npy') and path not in targets:
+                    os.remove(path)
+                    removed += 1
+            if not os.listdir(dirName) and os.path.normpath(dirName) not in targetDirs:
+                os.rmdir(dirName)
+    if removed:
+        print(f'Removed {removed} spectrograms of deleted wav files.')
+
+
+def make_packed(targetDir, manifest, batches, pending, num_workers, backend, dtype):
+    """Write the spectrograms to a single packed store instead of .npy files.
+
+    Up-to-date utterances are copied from the previous store, the others are
+    extracted and appended as they come. The new store replaces the previous
+    one only once every file has been processed.
+    """
+    if not batches and SpectStore.exists(targetDir):
+        old_store = SpectStore(targetDir)
+        if old_store.dtype == np.dtype(dtype) and \
+                set(old_store.keys()) == {entry[2] + '.npy' for entry in manifest.values()}:
+            return 0
+        del old_store
+    num_frames = 0
+    with SpectStoreWriter(targetDir, dtype=dtype, n_mels=SPEC_PARAMS['n_mels']) as writer:
+        if manifest:
+            old_store = SpectStore(targetDir)
+            for key, entry in manifest.items():
+                writer.add(entry[2] + '.npy', old_store[entry[2] + '.npy'])
+            # release the memory map before the store is replaced
+            del old_store
+        if num_workers > 1:
+            pool = Pool(num_workers, initializer=_init_worker, initargs=(backend,))
+            results = pool.imap_unordered(_extract_job, batches)
+        else:
+            pool = None
+            _init_worker(backend)
+            results = map(_extract_job, batches)
+        try:
+            for done, specs in tqdm.tqdm(results, total=len(batches)):
+                for job, S in zip(done, specs):
+                    writer.add(pending[job][1][2] + '.npy', S)
+                    num_frames += S.shape[0]
+        finally:
+            if pool is not None:
+                pool.terminate()
+    manifest.update(pending.values())
+    return num_frames
 
 
 if __name__ == '__main__':
@@ -92,5 +223,13 @@ if __name__ == '__main__':
 
     # dataset dir
     parser.add_argument('--dataset', type=str, default="voxceleb", help='dataset dir')
+    parser.add_argument('--num_workers', type=int, default=cpu_count(), help='number of extraction processes')
+    parser.add_argument('--force', action='store_true', help='recompute every spectrogram, ignoring the manifest')
+    parser.add_argument('--batch_size', type=int, default=16, help='number of files extracted per call')
+    parser.add_argument('--backend', type=str, default='numpy', choices=['numpy', 'torch'], help='STFT/mel backend')
+    parser.add_argument('--format', type=str, default='npy', choices=['npy', 'packed'],
+                        help='one .npy file per utterance or a single packed, memory-mappable store')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'], help='dtype of the packed store')
     config = parser.parse_args()
-    make_spec(config.dataset)
+    make_spec(config.dataset, config.num_workers, config.force, config.batch_size, config.backend,
+              config.format == 'packed', config.dtype)
@@ -0,0 +1,131 @@
+"""
+Batched mel-spectrogram extraction shared by preprocessing and conversion
+"""
+import time
+import numpy as np
+from scipy import signal
+from scipy.signal import get_window
+from librosa.filters import mel
+from librosa.core import load
+
+
+def butter_highpass(cutoff, fs, order=5):
+    nyq = 0.5 * fs
+    normal_cutoff = cutoff / nyq
+    b, a = signal.butter(order, normal_cutoff, btype='high', analog=False)
+    return b, a
+
+
+class MelSpectrogram(object):
+    """Compute normalized log-mel spectrograms for many utterances at once.
+
+    The frames of all the utterances of a batch are gathered into one matrix so
+    that the window, the FFT, the mel projection and the normalization each run
+    once per batch. The output matches the former per-file extraction of
+    make_spect within float tolerance (exactly with the numpy backend).
+    """
+
+    def __init__(self, sr=16000, fft_length=1024, hop_length=256, fmin=90, fmax=7600,
+                 n_mels=80, min_level_db=-100, cutoff=30, order=5, backend='numpy',
+                 max_frames=4096):
+        self.sr = sr
+        self.fft_length = fft_length
+        self.hop_length = hop_length
+        self.backend = backend
+        # maximum number of frames transformed in one go
+        self.max_frames = max_frames
+
+        self.window = get_window('hann', fft_length, fftbins=True)
+        self.mel_basis = mel(sr=sr, n_fft=fft_length, fmin=fmin, fmax=fmax, n_mels=n_mels).T
+        self.min_level = np.exp(min_level_db / 20 * np.log(10))
+        self.b, self.a = butter_highpass(cutoff, sr, order=order)
+        if backend == 'torch':
+            import torch
+            import torch.fft
+            self._torch = torch
+            self._window_t = torch.from_numpy(self.window).float()
+            self._mel_basis_t = torch.from_numpy(self.mel_basis).float()
+        elif backend != 'numpy':
+            raise ValueError(f'Unknown backend: {backend}')
+
+        # throughput statistics
+        self.num_frames = 0
+        self.elapsed = 0.
+
+    @property
+    def frames_per_second(self):
+        return self.num_frames / self.elapsed if self.elapsed > 0 else 0.
+
+    def load(self, wav_path):
+        """Read, high-pass filter and dither a wav file."""
+        prng = np.random.RandomState(1)
+        x, fs = load(wav_path, mono=True, sr=self.sr)
+        # Remove drifting noise
+        y = signal.filtfilt(self.b, self.a, x)
+        # Add a little random noise for model robustness
+        return y * 0.96 + (prng.rand(y.shape[0])-0.5)*1e-06
+
+    def frames(self, wav):
+        """Strided (num_frames, fft_length) view of a padded waveform."""
+        x = np.pad(wav, int(self.fft_length//2), mode='reflect')
+        num_frames = (x.shape[-1] - self.fft_length) // self.hop_length + 1
+        return np.lib.stride_tricks.as_strided(
+            x, shape=(num_frames, self.fft_length),
+            strides=(self.hop_length*x.strides[-1], x.strides[-1]))
+
+    def _spectrogram(self, frames):
+        if self.backend == 'torch':
+            torch = self._torch
+            with torch.no_grad():
+                frames = torch.from_numpy(frames).float()
+                frames.mul_(self._window_t)
+                D = torch.fft.rfft(frames, n=self.fft_length).abs()
+                D_mel = torch.matmul(D, self._mel_basis_t)
+                D_mel.clamp_(min=self.min_level).log10_().mul_(20).sub_(16)
+                D_mel.add_(100).div_(100).clamp_(0, 1)
+            return D_mel.numpy()
+        frames *= self.window
+        D = np.abs(np.fft.rfft(frames, n=self.fft_length))
+        D_mel = np.dot(D, self.mel_basis)
+        # Convert to dB and normalize, in place
+        np.maximum(self.min_level, D_mel, out=D_mel)
+        np.log10(D_mel, out=D_mel)
+        D_mel *= 20
+        D_mel -= 16
+        D_mel += 100
+        D_mel /= 100
+        np.clip(D_mel, 0, 1, out=D_mel)
+        return D_mel.astype(np.float32, copy=False)
+
+    def __call__(self, wavs):
+        """Return the float32 (num_frames, n_mels) spectrogram of each waveform."""
+        if len(wavs) == 0:
+            return []
+        start = time.time()
+        views = [self.frames(wav) for wav in wavs]
+        # bucket utterances by length so that each batch is filled evenly
+        order = sorted(range(len(views)), key=lambda k: views[k].shape[0])
+        specs = len(views) * [None]
+        batch = []
+        batch_frames = 0
+        for k in order + [None]:
+            if k is not None and (not batch or batch_frames + views[k].shape[0] <= self.max_frames):
+                batch.append(k)
+                batch_frames += views[k].shape[0]
+                continue
+            D_mel = self._spectrogram(np.concatenate([views[j] for j in batch]))
+            offset = 0
+            for j in batch:
+                specs[j] = D_mel[offset:offset+views[j].shape[0]]
+                offset += views[j].shape[0]
+            if k is not None:
+                batch, batch_frames = [k], views[k].shape[0]
+        self.num_frames += sum(view.shape[0] for view in views)
+        self.elapsed += time.time() - start
+        return specs
+
+    def from_files(self, wav_paths):
+        start = time.time()
+        wavs = [self.load(wav_path) for wav_path in wav_paths]
+        self.elapsed += time.time() - start
+        return self(wavs)
@@ -74,9 +74,9 @@ class Encoder(nn.Module):
         out_forward = outputs[:, :, :self.dim_neck]
         out_backward = outputs[:, :, self.dim_neck:]
         
-        codes = []
-        for i in range(0, outputs.size(1), self.freq):
-            codes.append(torch.cat((out_forward[:,i+self.freq-1,:],out_backward[:,i,:]), dim=-1))
+        # one code every freq frames: last forward and first backward output
+        codes = torch.cat((out_forward[:, self.freq-1::self.freq, :],
+                           out_backward[:, ::self.freq, :]), dim=-1)
 
         return codes
       
@@ -182,12 +182,10 @@ class Generator(nn.Module):
                 
         codes = self.encoder(x, c_org)
         if c_trg is None:
-            return torch.cat(codes, dim=-1)
+            return codes.reshape(codes.size(0), -1)
         
-        tmp = []
-        for code in codes:
-            tmp.append(code.unsqueeze(1).expand(-1,int(x.size(1)/len(codes)),-1))
-        code_exp = torch.cat(tmp, dim=1)
+        # upsample the codes back to the frame rate
+        code_exp = codes.repeat_interleave(x.size(1)//codes.size(1), dim=1)
         
         encoder_outputs = torch.cat((code_exp, c_trg.unsqueeze(1).expand(-1,x.size(1),-1)), dim=-1)
         
@@ -199,6 +197,6 @@ class Generator(nn.Module):
         mel_outputs = mel_outputs.unsqueeze(1)
         mel_outputs_postnet = mel_outputs_postnet.unsqueeze(1)
         
-        return mel_outputs, mel_outputs_postnet, torch.cat(codes, dim=-1)
+        return mel_outputs, mel_outputs_postnet, codes.reshape(codes.size(0), -1)
 
     
@@ -4,8 +4,11 @@ import torch.nn.functional as F
 import time
 import datetime
 import os
+import contextlib
+from torch.nn.parallel import DistributedDataParallel
 
-from torch_utils import device
+from torch_utils import device, autocast, grad_scaler, is_distributed, is_main_process
+from data_loader import DevicePrefetcher
 
 class Solver(object):
 
@@ -23,7 +26,11 @@ class Solver(object):
         self.freq = config.freq
         self.init_model = config.init_model
         self.init_iter = 0
-        self.loss = []
+        # loss of every iteration before this run, on the host
+        self.loss = torch.zeros(0)
+        # losses of the iterations of this run, kept on the device until saved
+        self.loss_buffer = None
+        self.num_done = 0
 
         # Training configurations.
         self.batch_size = config.batch_size
@@ -32,6 +39,9 @@ class Solver(object):
         self.saving_pace = config.save_every_n_iter
         self.saving_prefix = config.save_path
         self.learning_rate = config.learning_rate
+        self.precision = config.precision
+        # micro-batches per optimization step, of batch_size utterances each
+        self.grad_accum_steps = config.grad_accum_steps
 
         # Miscellaneous.
         self.device = device
@@ -51,11 +61,19 @@ class Solver(object):
         self.G = Generator(self.dim_neck, self.dim_emb, self.dim_pre, self.freq)
 
         self.g_optimizer = torch.optim.Adam(self.G.parameters(), self.learning_rate)
+        self.scaler = grad_scaler(self.precision)
 
         self.G.to(self.device)
+        # module run by the training loop, synchronizing the gradients in data-parallel training
+        self.model = self.G
+        if is_distributed():
+            self.model = DistributedDataParallel(
+                self.G, device_ids=[self.device] if torch.device(self.device).type == 'cuda' else None)
 
 
     def save_model(self, path = 'autovc.ckpt'):
+        if not is_main_process():
+            return
         torch.save({
             'G_state_dict': self.G.state_dict(),
             'hyperparams':{'dim_neck': self.dim_neck, 'dim_emb': self.dim_emb, 'dim_pre': self.dim_pre, 'freq': self.freq}
@@ -80,7 +98,10 @@ class Solver(object):
                 checkpoint = torch.load(self.init_model)
                 self.G.load_state_dict(checkpoint['G_state_dict'])
                 self.g_optimizer.load_state_dict(checkpoint['g_optimizer_state_dict'])
-                self.loss = checkpoint["G_loss"]
+                # float32 tensor, or a list in older checkpoints
+                self.loss = torch.as_tensor(checkpoint["G_loss"], dtype=torch.float32)
+                if 'scaler_state_dict' in checkpoint:
+                    self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
                 self.init_iter = len(self.loss)
                 del checkpoint
             except:
@@ -89,18 +110,34 @@ class Solver(object):
             raise Exception(f'Incorrect path: {self.init_model}')
 
     def save_trainable_model(self, path):
+        if not is_main_process():
+            return
         torch.save({
             'hyperparams':{'dim_neck': self.dim_neck, 'dim_emb': self.dim_emb, 'dim_pre': self.dim_pre, 'freq': self.freq},
             'G_state_dict': self.G.state_dict(),
             'g_optimizer_state_dict': self.g_optimizer.state_dict(),
-            'G_loss': self.loss
+            'scaler_state_dict': self.scaler.state_dict(),
+            'G_loss': self.loss_history()
             }, path)
 
 
+    def loss_history(self):
+        """Loss of every iteration, those of the current run included."""
+        if self.num_done == 0:
+            return self.loss
+        return torch.cat([self.loss, self.loss_buffer[:self.num_done].cpu()])
+
     def reset_grad(self):
         """Reset the gradient buffers."""
         self.g_optimizer.zero_grad()
 
+    def no_sync(self, sync):
+        """Context of a micro-batch, whose gradients are only averaged across
+        processes, by DDP, if sync is set."""
+        if sync or not is_distributed():
+            return contextlib.nullcontext()
+        return self.model.no_sync()
+
 
     #=====================================================================================================================================#
 
@@ -112,59 +149,64 @@ class Solver(object):
         keys = ['G/loss', 'G/loss_id','G/loss_id_psnt','G/loss_cd']
 
         # Start training.
-        print('Start training...')
+        if is_main_process():
+            print('Start training...')
+        data_iter = DevicePrefetcher(data_loader, self.device)
+        # Losses are accumulated on the device and only copied to the host
+        # when logged or saved, so that training never waits for them.
+        self.loss_buffer = torch.zeros(self.num_iters, device=self.device)
+        loss_sum = torch.zeros(len(keys), device=self.device)
         try:
             start_time = time.time()
+            # steps since the last log, fewer than log_step after resuming mid-interval
+            num_steps = 0
             for i in range(self.init_iter, self.init_iter + self.num_iters):
 
-                # =================================================================================== #
-                #                             1. Preprocess input data                                #
-                # =================================================================================== #
-
-                # Fetch data.
-                try:
-                    x_real, emb_org = next(data_iter)
-                except:
-                    data_iter = iter(data_loader)
-                    x_real, emb_org = next(data_iter)
-
-                x_real = x_real.to(self.device)
+                self.G = self.G.train()
+                self.reset_grad()
+                # Accumulate the gradients of grad_accum_steps micro-batches.
+                for k in range(self.grad_accum_steps):
 
-                emb_org = emb_org.to(self.device)
+                    # =================================================================================== #
+                    #                             1. Preprocess input data                                #
+                    # =================================================================================== #
 
+                    # Fetch data, already on the device.
+                    x_real, emb_org = next(data_iter)
 
-                # =================================================================================== #
-                #                               2. Train the generator                                #
-                # =================================================================================== #
+                    # =================================================================================== #
+                    #                               2. Train the generator                                #
+                    # =================================================================================== #
 
-                self.G = self.G.train()
+                    with self.no_sync(k == self.grad_accum_steps - 1):
+                        with autocast(self.precision):
+                            # Identity mapping loss
+                            x_identic, x_identic_psnt, code_real = self.model(x_real, emb_org, emb_org)
+                            x_real_reshaped = x_real.reshape((x_real.shape[0],1,x_real.shape[1],x_real.shape[2]))
+                            g_loss_id = F.mse_loss(x_real_reshaped, x_identic)
+                            g_loss_id_psnt = F.mse_loss(x_real_reshaped, x_identic_psnt)
+                            del x_real_reshaped
+                            # Code semantic loss.
+                            code_reconst = self.model(x_identic_psnt, emb_org, None)
+                            g_loss_cd = F.l1_loss(code_real, code_reconst)
 
-                # Identity mapping loss
-                x_identic, x_identic_psnt, code_real = self.G(x_real, emb_org, emb_org)
-                x_real_reshaped = x_real.reshape((x_real.shape[0],1,x_real.shape[1],x_real.shape[2]))
-                g_loss_id = F.mse_loss(x_real_reshaped, x_identic)
-                g_loss_id_psnt = F.mse_loss(x_real_reshaped, x_identic_psnt)
-                del x_real_reshaped
-                # Code semantic loss.
-                code_reconst = self.G(x_identic_psnt, emb_org, None)
-                g_loss_cd = F.l1_loss(code_real, code_reconst)
+                            del x_real, emb_org, x_identic, x_identic_psnt
 
-                del x_real, emb_org, x_identic, x_identic_psnt
 
+                            # Backward, the gradients of the micro-batches are averaged.
+                            g_loss = g_loss_id + g_loss_id_psnt + self.lambda_cd * g_loss_cd
+                        self.scaler.scale(g_loss / self.grad_accum_steps).backward()
 
-                # Backward and optimize.
-                g_loss = g_loss_id + g_loss_id_psnt + self.lambda_cd * g_loss_cd
-                self.loss.append(g_loss.item())
-                self.reset_grad()
-                g_loss.backward()
-                self.g_optimizer.step()
+                    # Logging, losses of the effective batch.
+                    step_loss = torch.stack([g_loss, g_loss_id, g_loss_id_psnt, g_loss_cd]).detach().float()
+                    loss_sum += step_loss / self.grad_accum_steps
+                    self.loss_buffer[self.num_done] += step_loss[0] / self.grad_accum_steps
 
-                # Logging.
-                loss = {}
-                loss['G/loss'] = g_loss.item()
-                loss['G/loss_id'] = g_loss_id.item()
-                loss['G/loss_id_psnt'] = g_loss_id_psnt.item()
-                loss['G/loss_cd'] = g_loss_cd.item()
+                # Optimize.
+                self.scaler.step(self.g_optimizer)
+                self.scaler.update()
+                self.num_done += 1
+                num_steps += 1
 
                 # =================================================================================== #
                 #                                 4. Miscellaneous                                    #
@@ -175,11 +217,15 @@ class Solver(object):
                     et = time.time() - start_time
                     et = str(datetime.timedelta(seconds=et))[:-7]
                     log = "Elapsed [{}], Iteration [{}/{}]".format(et, i+1, self.num_iters)
-                    for tag in keys:
-                        log += ", {}: {:.4f}".format(tag, loss[tag])
-                    print(log)
-
-                if self.saving_pace!=0 and (i+1) % self.saving_pace == 0:
+                    # mean losses since the last log, the only synchronization with the device
+                    for tag, value in zip(keys, (loss_sum / num_steps).tolist()):
+                        log += ", {}: {:.4f}".format(tag, value)
+                    if is_main_process():
+                        print(log)
+                    loss_sum.zero_()
+                    num_steps = 0
+
+                if self.saving_pace!=0 and (i+1) % self.saving_pace == 0 and is_main_process():
                     if not os.path.exists('./trained_models'):
                         os.mkdir('trained_models')
                     self.save_trainable_model(f'./trained_models/autovc_{self.saving_prefix}_{i+1}')
@@ -188,3 +234,5 @@ class Solver(object):
                 self.save_trainable_model('autovc_autosave.ckpt')
                 raise Exception('KeyboardInterrupt: autosave done.')
             raise Exception('KeyboardInterrupt: no autosave.')
+        self.loss = self.loss_history()
+        self.num_done = 0
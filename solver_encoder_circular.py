@@ -4,9 +4,12 @@ import torch.nn.functional as F
 import time
 import datetime
 import os
+import contextlib
+from torch.nn.parallel import DistributedDataParallel
 from make_metadata import load_speaker_embedding_model
 
-from torch_utils import device
+from torch_utils import device, autocast, grad_scaler, is_distributed, is_main_process, synchronize
+from data_loader import DevicePrefetcher
 
 class Solver(object):
 
@@ -24,8 +27,11 @@ class Solver(object):
         self.freq = config.freq
         self.init_model = config.init_model
         self.init_iter = 0
-        self.loss = []
-        self.speaker_embedder = load_speaker_embedding_model()
+        # loss of every iteration before this run, on the host
+        self.loss = torch.zeros(0)
+        # losses of the iterations of this run, kept on the device until saved
+        self.loss_buffer = None
+        self.num_done = 0
 
         # Training configurations.
         self.batch_size = config.batch_size
@@ -34,7 +40,15 @@ class Solver(object):
         self.saving_pace = config.save_every_n_iter
         self.saving_prefix = config.save_path
         self.learning_rate = config.learning_rate
+        self.precision = config.precision
+        # micro-batches per optimization step, of batch_size utterances each
+        self.grad_accum_steps = config.grad_accum_steps
         self.use_speaker_loss = config.use_speaker_loss
+        self.speaker_encoder = config.speaker_encoder
+        self.speaker_loss_every = config.speaker_loss_every
+        # None: same precision as the generator
+        self.speaker_loss_precision = config.speaker_loss_precision
+        self.time_speaker_loss = config.time_speaker_loss
 
         # Miscellaneous.
         self.device = device
@@ -54,11 +68,39 @@ class Solver(object):
         self.G = Generator(self.dim_neck, self.dim_emb, self.dim_pre, self.freq)
 
         self.g_optimizer = torch.optim.Adam(self.G.parameters(), self.learning_rate)
+        self.scaler = grad_scaler(self.precision)
 
         self.G.to(self.device)
+        # module run by the training loop, synchronizing the gradients in data-parallel training
+        self.model = self.G
+        if is_distributed():
+            self.model = DistributedDataParallel(
+                self.G, device_ids=[self.device] if torch.device(self.device).type == 'cuda' else None)
+
+        # The speaker encoder is only used by the style loss, it is not trained.
+        # It stays in train mode: the style loss backpropagates through its
+        # LSTM, which cuDNN only supports in training mode, and it has no
+        # dropout or normalization layer that train mode would change.
+        self.speaker_embedder = None
+        if self.use_speaker_loss:
+            self.speaker_embedder = load_speaker_embedding_model(self.speaker_encoder).train()
+            self.speaker_embedder.requires_grad_(False)
+
+    def embed_speaker(self, x):
+        """Embeddings of the converted spectrograms x, differentiable with
+        respect to x only."""
+        if self.speaker_loss_precision is None:
+            return self.speaker_embedder(x)
+        if self.speaker_loss_precision == 'fp32':
+            with torch.autocast(torch.device(self.device).type, enabled=False):
+                return self.speaker_embedder(x.float())
+        with autocast(self.speaker_loss_precision):
+            return self.speaker_embedder(x)
 
 
     def save_model(self, path = 'autovc.ckpt'):
+        if not is_main_process():
+            return
         torch.save({
             'G_state_dict': self.G.state_dict(),
             'hyperparams':{'dim_neck': self.dim_neck, 'dim_emb': self.dim_emb, 'dim_pre': self.dim_pre, 'freq': self.freq}
@@ -83,7 +125,10 @@ class Solver(object):
                 checkpoint = torch.load(self.init_model)
                 self.G.load_state_dict(checkpoint['G_state_dict'])
                 self.g_optimizer.load_state_dict(checkpoint['g_optimizer_state_dict'])
-                self.loss = checkpoint["G_loss"]
+                # float32 tensor, or a list in older checkpoints
+                self.loss = torch.as_tensor(checkpoint["G_loss"], dtype=torch.float32)
+                if 'scaler_state_dict' in checkpoint:
+                    self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
                 self.init_iter = len(self.loss)
                 del checkpoint
             except:
@@ -92,18 +137,50 @@ class Solver(object):
             raise Exception(f'Incorrect path: {self.init_model}')
 
     def save_trainable_model(self, path):
+        if not is_main_process():
+            return
         torch.save({
             'hyperparams':{'dim_neck': self.dim_neck, 'dim_emb': self.dim_emb, 'dim_pre': self.dim_pre, 'freq': self.freq},
             'G_state_dict': self.G.state_dict(),
             'g_optimizer_state_dict': self.g_optimizer.state_dict(),
-            'G_loss': self.loss
+            'scaler_state_dict': self.scaler.state_dict(),
+            'G_loss': self.loss_history()
             }, path)
 
 
+    def loss_history(self):
+        """Loss of every iteration, those of the current run included."""
+        if self.num_done == 0:
+            return self.loss
+        return torch.cat([self.loss, self.loss_buffer[:self.num_done].cpu()])
+
     def reset_grad(self):
         """Reset the gradient buffers."""
         self.g_optimizer.zero_grad()
 
+    def no_sync(self, sync):
+        """Context of a micro-batch, whose gradients are only averaged across
+        processes, by DDP, if sync is set."""
+        if sync or not is_distributed():
+            return contextlib.nullcontext()
+        return self.model.no_sync()
+
+
+    def timing_log(self, timing):
+        """Share of the training time spent on the speaker style loss."""
+        step = timing['step'] / max(timing['steps'], 1)
+        log = "Step: {:.1f}ms".format(step * 1e3)
+        if timing['steps_style']:
+            style = timing['style'] / timing['steps_style']
+            log += ", speaker loss forward: {:.1f}ms ({:.1%} of its steps)".format(
+                style * 1e3, timing['style'] / timing['step_style'])
+            num_plain = timing['steps'] - timing['steps_style']
+            if num_plain:
+                # full cost of the style loss, backward included
+                step_style = timing['step_style'] / timing['steps_style']
+                step_plain = (timing['step'] - timing['step_style']) / num_plain
+                log += ", steps with/without it: {:.1f}/{:.1f}ms".format(step_style * 1e3, step_plain * 1e3)
+        return log
 
     #=====================================================================================================================================#
 
@@ -117,74 +194,100 @@ class Solver(object):
             keys.append('G/loss_tgt_style')
 
         # Start training.
-        print('Start training...')
+        if is_main_process():
+            print('Start training...')
+        data_iter = DevicePrefetcher(data_loader, self.device)
+        # Losses are accumulated on the device and only copied to the host
+        # when logged or saved, so that training never waits for them.
+        self.loss_buffer = torch.zeros(self.num_iters, device=self.device)
+        loss_sum = torch.zeros(5, device=self.device)
+        no_style_loss = torch.zeros((), device=self.device)
         try:
             start_time = time.time()
-            loss = {}
+            # steps since the last log, fewer than log_step after resuming
+            # mid-interval, and those with the style loss
+            num_steps = 0
+            num_style = 0
+            # step and style loss durations, in seconds, since the last log
+            timing = {'step': 0., 'steps': 0, 'style': 0., 'step_style': 0., 'steps_style': 0}
             for i in range(self.init_iter, self.init_iter + self.num_iters):
 
-                # =================================================================================== #
-                #                             1. Preprocess input data                                #
-                # =================================================================================== #
-
-                # Fetch data.
-                try:
-                    x_real, emb_org, emb_target = next(data_iter)
-                except:
-                    data_iter = iter(data_loader)
-                    x_real, emb_org, emb_target = next(data_iter)
-
-                x_real = x_real.to(self.device)
+                self.G = self.G.train()
+                with_style = self.use_speaker_loss and i % self.speaker_loss_every == 0
+                if self.time_speaker_loss:
+                    synchronize()
+                    step_start = time.perf_counter()
+                self.reset_grad()
+                # Accumulate the gradients of grad_accum_steps micro-batches.
+                for k in range(self.grad_accum_steps):
 
-                emb_org = emb_org.to(self.device)
+                    # =================================================================================== #
+                    #                             1. Preprocess input data                                #
+                    # =================================================================================== #
 
-                emb_target = emb_target.to(self.device)
+                    # Fetch data, already on the device.
+                    x_real, emb_org, emb_target = next(data_iter)
 
 
-                # =================================================================================== #
-                #                               2. Train the generator                                #
-                # =================================================================================== #
+                    # =================================================================================== #
+                    #                               2. Train the generator                                #
+                    # =================================================================================== #
 
-                self.G = self.G.train()
-
-                # Circular mapping loss
-                x_target_pred, x_target_pred_psnt, code_org = self.G(x_real, emb_org, emb_target)
-                x_org_reconst, x_org_reconst_psnt, code_target_pred = self.G(x_target_pred.reshape(x_real.shape), emb_target, emb_org)
-                x_real_reshaped = x_real.reshape((x_real.shape[0],1,x_real.shape[1],x_real.shape[2]))
-                g_loss_id = F.mse_loss(x_real_reshaped, x_org_reconst)
-                g_loss_id_psnt = F.mse_loss(x_real_reshaped, x_org_reconst_psnt)
+                    with self.no_sync(k == self.grad_accum_steps - 1):
+                        with autocast(self.precision):
+                            # Circular mapping loss
+                            x_target_pred, x_target_pred_psnt, code_org = self.model(x_real, emb_org, emb_target)
+                            x_org_reconst, x_org_reconst_psnt, code_target_pred = self.model(x_target_pred.reshape(x_real.shape), emb_target, emb_org)
+                            x_real_reshaped = x_real.reshape((x_real.shape[0],1,x_real.shape[1],x_real.shape[2]))
+                            g_loss_id = F.mse_loss(x_real_reshaped, x_org_reconst)
+                            g_loss_id_psnt = F.mse_loss(x_real_reshaped, x_org_reconst_psnt)
 
-                # Code semantic loss.
-                g_loss_cd = F.l1_loss(code_org, code_target_pred)
+                            # Code semantic loss.
+                            g_loss_cd = F.l1_loss(code_org, code_target_pred)
 
-                # Output style domain loss
+                            # Output style domain loss
 
-                g_loss_target_style = torch.Tensor([0]).to(self.device)
-                if self.use_speaker_loss:
-                    emb_target_pred = self.speaker_embedder(x_target_pred_psnt.reshape(x_real.shape)).to(self.device)
-                    g_loss_target_style = F.l1_loss(emb_target_pred, emb_target)
+                            g_loss_target_style = no_style_loss
+                            if with_style:
+                                if self.time_speaker_loss:
+                                    synchronize()
+                                    style_start = time.perf_counter()
+                                emb_target_pred = self.embed_speaker(x_target_pred_psnt.reshape(x_real.shape))
+                                g_loss_target_style = F.l1_loss(emb_target_pred.float(), emb_target)
+                                if self.time_speaker_loss:
+                                    synchronize()
+                                    timing['style'] += time.perf_counter() - style_start
 
 
-                del x_real, x_real_reshaped, emb_org, x_org_reconst, x_org_reconst_psnt, x_target_pred, x_target_pred_psnt, code_org
+                            del x_real, x_real_reshaped, emb_org, x_org_reconst, x_org_reconst_psnt, x_target_pred, x_target_pred_psnt, code_org
 
 
-                # Backward and optimize.
-                g_loss = g_loss_id + g_loss_id_psnt + g_loss_target_style + self.lambda_cd * g_loss_cd
+                            # Backward, the gradients of the micro-batches are averaged.
+                            g_loss = g_loss_id + g_loss_id_psnt + g_loss_target_style + self.lambda_cd * g_loss_cd
+                        self.scaler.scale(g_loss / self.grad_accum_steps).backward()
 
-                # Logging.
-                loss['G/loss'] = g_loss.item() + loss.get('G/loss', 0)
-                loss['G/loss_id'] = g_loss_id.item() + loss.get('G/loss_id', 0)
-                loss['G/loss_id_psnt'] = g_loss_id_psnt.item() + loss.get('G/loss_id_psnt', 0)
-                loss['G/loss_cd'] = g_loss_cd.item() + loss.get('G/loss_cd', 0)
-                loss['G/loss_tgt_style'] = g_loss_target_style.item() + loss.get('G/loss_tgt_style', 0)
+                    # Logging, losses of the effective batch.
+                    step_loss = torch.stack([g_loss, g_loss_id, g_loss_id_psnt, g_loss_cd, g_loss_target_style]).detach().float()
+                    loss_sum += step_loss / self.grad_accum_steps
+                    self.loss_buffer[self.num_done] += step_loss[0] / self.grad_accum_steps
 
-                del g_loss_id, g_loss_id_psnt, g_loss_cd, g_loss_target_style
+                    del g_loss_id, g_loss_id_psnt, g_loss_cd, g_loss_target_style
 
-                self.loss.append(g_loss.item())
-                self.reset_grad()
-                g_loss.backward()
-                self.g_optimizer.step()
+                # Optimize.
+                self.scaler.step(self.g_optimizer)
+                self.scaler.update()
+                self.num_done += 1
+                num_steps += 1
+                num_style += with_style
 
+                if self.time_speaker_loss:
+                    synchronize()
+                    step_time = time.perf_counter() - step_start
+                    timing['step'] += step_time
+                    timing['steps'] += 1
+                    if with_style:
+                        timing['step_style'] += step_time
+                        timing['steps_style'] += 1
 
 
                 # =================================================================================== #
@@ -196,12 +299,24 @@ class Solver(object):
                     et = time.time() - start_time
                     et = str(datetime.timedelta(seconds=et))[:-7]
                     log = "Elapsed [{}], Iteration [{}/{}]".format(et, i+1, self.num_iters)
-                    for tag in keys:
-                        log += ", {}: {:.4f}".format(tag, loss[tag]/self.log_step)
-                    print(log)
-                    loss = {}
-
-                if self.saving_pace!=0 and (i+1) % self.saving_pace == 0:
+                    # mean losses since the last log, the only synchronization with the device
+                    for tag, value in zip(keys, loss_sum.tolist()):
+                        if tag == 'G/loss_tgt_style':
+                            # style loss, averaged over the steps where it was computed
+                            if num_style:
+                                log += ", {}: {:.4f}".format(tag, value / num_style)
+                        else:
+                            log += ", {}: {:.4f}".format(tag, value / num_steps)
+                    if is_main_process():
+                        print(log)
+                        if self.time_speaker_loss:
+                            print(self.timing_log(timing))
+                    loss_sum.zero_()
+                    num_steps = 0
+                    num_style = 0
+                    timing = dict.fromkeys(timing, 0)
+
+                if self.saving_pace!=0 and (i+1) % self.saving_pace == 0 and is_main_process():
                     if not os.path.exists('./trained_models'):
                         os.mkdir('trained_models')
                     self.save_trainable_model(f'./trained_models/autovc_{self.saving_prefix}_{i+1}')
@@ -210,3 +325,5 @@ class Solver(object):
                 self.save_trainable_model('autovc_autosave.ckpt')
                 raise Exception('KeyboardInterrupt: autosave done.')
             raise Exception('KeyboardInterrupt: no autosave.')
+        self.loss = self.loss_history()
+        self.num_done = 0
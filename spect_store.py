@@ -0,0 +1,105 @@
+"""
+Packed storage of the mel-spectrograms of a dataset
+
+All the frames are stored back to back in a single binary file, read through
+np.memmap, and an index maps each utterance ('<speaker>/<file>.npy', as listed
+in train.pkl) to its offset and length in frames.
+"""
+import os
+import pickle
+import numpy as np
+
+FRAMES_NAME = 'spmel.bin'
+INDEX_NAME = 'spmel_index.pkl'
+
+
+class SpectStoreWriter(object):
+    """Append spectrograms to a new packed store, published on close()."""
+
+    def __init__(self, root_dir, dtype='float32', n_mels=80):
+        self.root_dir = root_dir
+        self.dtype = np.dtype(dtype)
+        self.n_mels = n_mels
+        self.utterances = {}
+        self.num_frames = 0
+        self.frames_path = os.path.join(root_dir, FRAMES_NAME)
+        self.handle = open(self.frames_path + '.tmp', 'wb')
+
+    def add(self, key, mel):
+        key = key.replace('\\', '/')
+        assert mel.shape[1] == self.n_mels
+        self.handle.write(np.ascontiguousarray(mel, dtype=self.dtype).tobytes())
+        self.utterances[key] = (self.num_frames, mel.shape[0])
+        self.num_frames += mel.shape[0]
+
+    def close(self):
+        self.handle.close()
+        speakers = {}
+        for key in sorted(self.utterances):
+            speakers.setdefault(key.split('/')[0], []).append(key)
+        index = {
+            'dtype': self.dtype.str,
+            'n_mels': self.n_mels,
+            'num_frames': self.num_frames,
+            'utterances': self.utterances,
+            'speakers': speakers,
+        }
+        index_path = os.path.join(self.root_dir, INDEX_NAME)
+        with open(index_path + '.tmp', 'wb') as handle:
+            pickle.dump(index, handle)
+        os.replace(self.frames_path + '.tmp', self.frames_path)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.handle.close()
+            os.remove(self.frames_path + '.tmp')
+
+
+class SpectStore(object):
+    """Read-only, memory-mapped access to a packed store."""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        with open(os.path.join(root_dir, INDEX_NAME), 'rb') as handle:
+            index = pickle.load(handle)
+        self.dtype = np.dtype(index['dtype'])
+        self.n_mels = index['n_mels']
+        self.utterances = index['utterances']
+        self.speakers = index['speakers']
+        if index['num_frames'] > 0:
+            self.frames = np.memmap(os.path.join(root_dir, FRAMES_NAME), dtype=self.dtype,
+                                    mode='r', shape=(index['num_frames'], self.n_mels))
+        else:
+            self.frames = np.zeros((0, self.n_mels), dtype=self.dtype)
+
+    @staticmethod
+    def exists(root_dir):
+        return os.path.isfile(os.path.join(root_dir, INDEX_NAME))
+
+    @staticmethod
+    def remove(root_dir):
+        """Delete the store of root_dir, if any, index first."""
+        for name in (INDEX_NAME, FRAMES_NAME):
+            path = os.path.join(root_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def __contains__(self, key):
+        return key in self.utterances
+
+    def __getitem__(self, key):
+        """Zero-copy (num_frames, n_mels) view of an utterance."""
+        offset, length = self.utterances[key]
+        return self.frames[offset:offset+length]
+
+    def __len__(self):
+        return len(self.utterances)
+
+    def keys(self):
+        return self.utterances.keys()
@@ -5,17 +5,21 @@ Synthesis waveform from trained WaveNet.
 Modified from https://github.com/r9y9/wavenet_vocoder
 """
 
+import threading
+import numpy as np
 import torch
 from tqdm import tqdm
 import librosa
+from librosa.filters import mel
 from hparams import hparams
-from wavenet_vocoder import builder
 from torch_utils import device
 
 torch.set_num_threads(4)
 
 
 def build_model():
+    # only needed by the WaveNet vocoder
+    from wavenet_vocoder import builder
 
     model = getattr(builder, hparams.builder)(
         out_channels=hparams.out_channels,
@@ -70,3 +74,129 @@ def wavegen(model, c=None, tqdm=tqdm):
     y_hat = y_hat.view(-1).cpu().data.numpy()
 
     return y_hat
+
+
+def wavegen_batch(model, cs, tqdm=tqdm):
+    """Generate the waveforms of several utterances in one incremental loop.
+
+    The conditioning features are padded to the longest utterance, by
+    repeating its last frame, and each waveform is trimmed to its own length
+    afterwards. Sort cs by length to keep the padding small.
+    """
+
+    model.eval()
+    model.make_generation_fast_()
+
+    upsample_factor = hparams.hop_size
+    lengths = [c.shape[0] for c in cs]
+    Tc = max(lengths)
+    length = Tc * upsample_factor
+
+    # B x C x T
+    c = np.stack([np.pad(c, ((0, Tc - c.shape[0]), (0, 0)), mode='edge') for c in cs])
+    c = torch.from_numpy(c.transpose(0, 2, 1)).float().to(device)
+
+    initial_input = torch.zeros(len(cs), 1, 1).to(device)
+
+    with torch.no_grad():
+        # incremental_forward takes its batch size from test_inputs only, the
+        # batched start sample is passed there as the first teacher input
+        y_hat = model.incremental_forward(
+            initial_input, c=c, g=None, T=length, test_inputs=initial_input, tqdm=tqdm,
+            softmax=True, quantize=True, log_scale_min=hparams.log_scale_min)
+
+    y_hat = y_hat.view(len(cs), -1).cpu().data.numpy()
+
+    return [y_hat[k, :lengths[k] * upsample_factor] for k in range(len(cs))]
+
+
+class Vocoder(object):
+    """Turn normalized (num_frames, 80) mel-spectrograms, as computed by
+    make_spect, into 16 kHz waveforms."""
+
+    sample_rate = hparams.sample_rate
+
+    def __call__(self, c):
+        raise NotImplementedError
+
+    def batch(self, cs, batch_size=8):
+        return [self(c) for c in cs]
+
+
+class WaveNetVocoder(Vocoder):
+    """Autoregressive WaveNet, one sample at a time: best quality, slowest.
+
+    incremental_forward keeps the input buffers of the generation in the
+    model, so a shared instance generates for one caller at a time.
+    """
+
+    def __init__(self, checkpoint_path='checkpoint_step001000000_ema.pth'):
+        self.model = build_model().to(device)
+        checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
+        self.model.load_state_dict(checkpoint["state_dict"])
+        self.lock = threading.Lock()
+
+    def __call__(self, c):
+        with self.lock:
+            return wavegen(self.model, c=c)
+
+    def batch(self, cs, batch_size=8):
+        """Generate batch_size utterances of similar length at a time, so that
+        the cost of each step of the network is shared between them."""
+        order = sorted(range(len(cs)), key=lambda k: cs[k].shape[0])
+        waveforms = len(cs) * [None]
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start+batch_size]
+            with self.lock:
+                ys = wavegen_batch(self.model, [cs[k] for k in indices])
+            for k, y in zip(indices, ys):
+                waveforms[k] = y
+        return waveforms
+
+
+class GriffinLimVocoder(Vocoder):
+    """Non-neural inversion: mel to linear spectrogram by the pseudo-inverse
+    of the mel basis, then Griffin-Lim phase reconstruction. Needs no
+    checkpoint."""
+
+    def __init__(self, checkpoint_path=None, n_iter=32):
+        self.n_iter = n_iter
+        # same analysis parameters as make_spect
+        self.mel_basis_inv = np.linalg.pinv(mel(sr=16000, n_fft=1024, fmin=90, fmax=7600, n_mels=80))
+        self.min_level = np.exp(-100 / 20 * np.log(10))
+
+    def __call__(self, c):
+        # undo the dB normalization of make_spect
+        D_mel = np.power(10.0, ((np.asarray(c, dtype=np.float64) * 100 - 100) + 16) / 20)
+        S = np.maximum(self.min_level, np.dot(self.mel_basis_inv, D_mel.T))
+        wav = librosa.griffinlim(S, n_iter=self.n_iter, hop_length=256, win_length=1024, window='hann')
+        return np.clip(wav / 0.96, -1, 1).astype(np.float32)
+
+
+class TorchScriptVocoder(Vocoder):
+    """Slot for parallel neural vocoders (MelGAN, HiFi-GAN, ...) exported with
+    TorchScript, mapping a (batch, 80, num_frames) mel-spectrogram to a
+    (batch, 1, num_frames * hop_size) waveform."""
+
+    def __init__(self, checkpoint_path):
+        self.model = torch.jit.load(checkpoint_path, map_location=device).eval()
+
+    def __call__(self, c):
+        with torch.no_grad():
+            y = self.model(torch.from_numpy(np.ascontiguousarray(c.T)).float().unsqueeze(0).to(device))
+        return y.view(-1).cpu().numpy()
+
+
+VOCODERS = {
+    'wavenet': WaveNetVocoder,
+    'griffinlim': GriffinLimVocoder,
+    'torchscript': TorchScriptVocoder,
+}
+
+
+def load_vocoder(name='wavenet', checkpoint_path=None):
+    if name not in VOCODERS:
+        raise ValueError(f'Unknown vocoder {name}, choose among {", ".join(VOCODERS)}')
+    if checkpoint_path is None:
+        return VOCODERS[name]()
+    return VOCODERS[name](checkpoint_path)
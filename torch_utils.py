@@ -1,3 +1,83 @@
+import os
+import contextlib
+import numpy as np
 import torch
+import torch.distributed as dist
 
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
+# In data-parallel training (launched by torchrun) each process uses the GPU
+# of its local rank.
+device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}" if torch.cuda.is_available() else "cpu"
+
+
+def autocast(precision='fp32'):
+    """Autocast context of the 'fp16' and 'bf16' mixed-precision modes on
+    the training device, no-op in 'fp32'."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'fp16' and torch.device(device).type != 'cuda':
+        raise ValueError('fp16 mixed precision needs a CUDA device, use bf16 on CPU.')
+    dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+
+def grad_scaler(precision='fp32'):
+    """Loss scaler, only enabled for fp16 whose gradients may underflow."""
+    if precision == 'fp16' and torch.device(device).type != 'cuda':
+        raise ValueError('fp16 mixed precision needs a CUDA device, use bf16 on CPU.')
+    # torch.amp.GradScaler only exists from torch 2.3, torch.cuda.amp's before
+    GradScaler = getattr(getattr(torch, 'amp', None), 'GradScaler', None)
+    if GradScaler is not None:
+        return GradScaler('cuda', enabled=precision == 'fp16')
+    return torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+
+def synchronize():
+    """Wait for the work queued on the device, so that it can be timed."""
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+#======================================== Data parallelism ========================================#
+
+def init_distributed(backend='gloo'):
+    """Join the process group described by the environment of torchrun, if
+    any. Return whether training is distributed."""
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(device)
+        dist.init_process_group(backend)
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Only the first process logs and saves checkpoints."""
+    return get_rank() == 0
+
+
+def shared_seed(seed=None):
+    """seed, or a random seed drawn by the first process and shared by all."""
+    if seed is not None:
+        return seed
+    seed = [int(np.random.randint(2**31))]
+    if is_distributed():
+        dist.broadcast_object_list(seed, src=0)
+    return seed[0]
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()